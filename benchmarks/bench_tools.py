@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Benchmark the WebApp tools against an in-memory kopano stand-in
+
+Generates users with realistic settings (state, signatures, sendas
+addresses), recipient histories and S/MIME certificates in a fake server
+(fake_kopano.py) and runs the tools against it. Every server call sleeps for
+the configured latency. Reports the processed users per second, the peak
+memory and the number of server calls per benchmark.
+
+Usage: python3 bench_tools.py [--users N] [--latency MS] [--jobs N]
+"""
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import fake_kopano
+import json_codec
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+"""
+Load one of the tools as a module
+
+:param name: Module name
+:param path: Path of the script relative to the repository
+:return: The module
+"""
+def load_tool(name, path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+"""
+Generate a recipient history
+
+:param count: Number of recipients
+:return: Serialized recipient history
+"""
+def generate_recipients(count):
+    recipients = []
+    for i in range(count):
+        recipients.append({
+            'display_name': 'Recipient %d' % i,
+            'smtp_address': 'recipient%d@partner%d.example.com' % (i, i % 40),
+            'email_address': 'recipient%d@partner%d.example.com' % (i, i % 40),
+            'address_type': 'SMTP',
+            'object_type': 6,
+            'display_type': 0,
+            'count': i % 17,
+            'last_used': 1600000000 + i,
+        })
+    return json.dumps({'recipients': recipients})
+
+
+"""
+(Re)create the users of the fake server
+
+:param options: Benchmark options
+"""
+def setup_users(options):
+    fake_kopano.USERS.clear()
+    fake_kopano.GROUPS.clear()
+    settings = json.dumps(json_codec.generate_settings(options.state_items, options.signatures, options.signature_size, options.sendas))
+    persistent_settings = json.dumps({'settings': {'kopano': {'main': {'categories': [
+        {'name': 'Category %d' % i, 'color': '#%06x' % (i * 4000), 'standardIndex': i} for i in range(12)]}}}})
+    recipients = generate_recipients(options.recipients)
+    for i in range(options.users):
+        fake_kopano.add_user('user%05d' % i, settings, persistent_settings, recipients, options.certificates, aliases=3)
+
+
+"""
+Run a benchmark twice: timed, and with tracemalloc for the peak memory
+
+:param options: Benchmark options
+:param function: Function running the benchmark
+:return: Tuple of duration, peak memory and the number of server calls
+"""
+def measure(options, function):
+    setup_users(options)
+    fake_kopano.stats.reset()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        function()
+    duration = time.perf_counter() - start
+    calls = sum(fake_kopano.stats.calls.values())
+
+    setup_users(options)
+    latency = fake_kopano.stats.latency
+    fake_kopano.stats.latency = 0
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    fake_kopano.stats.latency = latency
+    return duration, peak, calls
+
+
+"""
+Run kopano-webapp-admin for all users
+
+:param webapp_admin: The kopano-webapp-admin module
+:param jobs: Number of parallel workers
+:param args: Arguments of kopano-webapp-admin
+"""
+def run_webapp_admin(webapp_admin, jobs, *args):
+    sys.argv = ['kopano-webapp-admin', '--all-users'] + list(args)
+    if jobs > 1:
+        sys.argv += ['--jobs', str(jobs)]
+    try:
+        webapp_admin.main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError('kopano-webapp-admin exited with code {}'.format(e.code))
+
+
+"""
+Run manage_recipients for all users
+
+:param manage_recipients: The manage_recipients module
+:param jobs: Number of parallel workers
+:param args: Arguments of manage_recipients
+"""
+def run_manage_recipients(manage_recipients, jobs, *args):
+    sys.argv = ['manage_recipients', '--all-users'] + list(args)
+    if jobs > 1:
+        sys.argv += ['--jobs', str(jobs)]
+    try:
+        manage_recipients.main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError('manage_recipients exited with code {}'.format(e.code))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--users", dest="users", action="store", type="int", default=200, help="Number of users")
+    parser.add_option("--latency", dest="latency", action="store", type="float", default=1.0, help="Latency of a server call in milliseconds")
+    parser.add_option("--jobs", dest="jobs", action="store", type="int", default=1, help="Number of parallel workers for kopano-webapp-admin")
+    parser.add_option("--state-items", dest="state_items", action="store", type="int", default=500, help="Number of state entries in the settings")
+    parser.add_option("--signatures", dest="signatures", action="store", type="int", default=2, help="Number of signatures per user")
+    parser.add_option("--signature-size", dest="signature_size", action="store", type="int", default=20000, help="Size of the inline image of a signature in bytes")
+    parser.add_option("--sendas", dest="sendas", action="store", type="int", default=10, help="Number of sendas addresses per user")
+    parser.add_option("--recipients", dest="recipients", action="store", type="int", default=500, help="Number of recipients in the history")
+    parser.add_option("--certificates", dest="certificates", action="store", type="int", default=4, help="Number of S/MIME certificates per user")
+    parser.add_option("--only", dest="only", action="store", help="Only run the benchmarks containing this text")
+    options, args = parser.parse_args()
+
+    fake_kopano.install()
+    fake_kopano.stats.latency = options.latency / 1000.0
+    webapp_admin = load_tool('webapp_admin', 'webapp_admin/kopano-webapp-admin.py')
+    manage_recipients = load_tool('manage_recipients', 'manage_recipients/manage_recipients.py')
+
+    location = tempfile.mkdtemp()
+    # Files to restore from
+    setup_users(options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_webapp_admin(webapp_admin, 1, '--backup', '--location', location)
+    cwd = os.getcwd()
+    os.chdir(location)
+
+    # 500 removal patterns of every kind
+    patterns = os.path.join(location, 'patterns.txt')
+    with open(patterns, 'w') as f:
+        for i in range(500):
+            f.write(['exact:recipient%d@partner%d.example.com\n', 'domain:partner%d.example.org\n',
+                     'regex:^Departed %d\\b\n', 'Compromised %d\n'][i % 4] % ((i, i % 40) if i % 4 == 0 else (i,)))
+
+    # Company categories, half of them already known to the users
+    categories = os.path.join(location, 'categories.json')
+    with open(categories, 'w') as f:
+        json.dump([{'name': 'Category %d' % i, 'color': '#%06x' % (i * 8000)} for i in range(6, 18)], f)
+
+    jobs = options.jobs
+    benchmarks = [
+        ('webapp-admin backup', lambda: run_webapp_admin(webapp_admin, jobs, '--backup', '--location', location)),
+        ('webapp-admin backup_signature', lambda: run_webapp_admin(webapp_admin, jobs, '--backup-signature', '--incremental', '--location', location)),
+        ('webapp-admin restore', lambda: run_webapp_admin(webapp_admin, jobs, '--restore')),
+        ('webapp-admin advanced_inject', lambda: run_webapp_admin(webapp_admin, jobs, '--add-option', 'settings.zarafa.v1.main.active_theme = dark')),
+        ('webapp-admin add_sendas', lambda: run_webapp_admin(webapp_admin, jobs, '--add-sent-from', '--sent-from-name', 'Sales', '--sent-from-email', 'sales@example.com')),
+        ('webapp-admin merge_categories', lambda: run_webapp_admin(webapp_admin, jobs, '--merge-categories', categories, '--update-colors')),
+        ('webapp-admin export_smime', lambda: run_webapp_admin(webapp_admin, jobs, '--export-smime', '--location', location)),
+        ('manage_recipients list', lambda: run_manage_recipients(manage_recipients, jobs, '--list')),
+        ('manage_recipients remove', lambda: run_manage_recipients(manage_recipients, jobs, '--remove', 'partner7.example.com')),
+        ('manage_recipients remove-file', lambda: run_manage_recipients(manage_recipients, jobs, '--remove-file', patterns)),
+        ('manage_recipients export', lambda: run_manage_recipients(manage_recipients, jobs, '--export', os.path.join(location, 'recipients.jsonl'))),
+        ('manage_recipients import', lambda: run_manage_recipients(manage_recipients, jobs, '--import', os.path.join(location, 'recipients.jsonl'))),
+    ]
+
+    try:
+        files_admin = load_tool('files_admin', 'files_admin/files_admin.py')
+    except ImportError as e:
+        print('Skipping files_admin: {}'.format(e))
+    else:
+        files_options = files_admin.opt_args(['--all-users', '--jobs', str(jobs), '--file', ','.join(
+            os.path.join(ROOT, 'files_admin', name) for name in ('ftp.cfg', 'owncloud.cfg', 'smb.cfg'))])[0]
+        # Encode in-process when cryptography is installed, like on a server with the Files plugin configured
+        files_config = os.path.join(location, 'config-files.php')
+        with open(files_config, 'w') as f:
+            f.write("<?php\ndefine('FILES_PASSWORD_KEY', 'benchmarkkey');\ndefine('FILES_PASSWORD_IV', 'benchiv1');\n")
+        files_admin.load_encoder(files_config)
+
+        def run_files():
+            if files_admin.provision(fake_kopano.Server(), files_options):
+                raise RuntimeError('files_admin failed for some users')
+
+        benchmarks.append(('files_admin provision', run_files))
+
+    print('{} users, {} ms latency per server call, {} jobs'.format(options.users, options.latency, jobs))
+    print('{:<30} {:>10} {:>12} {:>14} {:>14}'.format('benchmark', 'seconds', 'users/sec', 'peak memory', 'server calls'))
+    try:
+        for name, function in benchmarks:
+            if options.only and options.only not in name:
+                continue
+            try:
+                duration, peak, calls = measure(options, function)
+            except Exception as e:
+                print('{:<30} failed: {!r}'.format(name, e))
+                continue
+            print('{:<30} {:>10.2f} {:>12.1f} {:>11.1f} MB {:>14}'.format(name, duration, options.users / duration, peak / 1048576.0, calls))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(location)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+# encoding: utf-8
+"""
+In-memory stand-in for python-kopano and python-mapi
+
+Only the parts of the object model that are used by the WebApp tools are
+implemented. Every call that would be a round trip to kopano-server sleeps for
+the configured latency and is counted, so the tools can be benchmarked
+without a server.
+
+install() registers the kopano and MAPI modules in sys.modules and must be
+called before a tool is loaded.
+"""
+import base64
+import binascii
+import optparse
+import os
+import sys
+import threading
+import time
+import types
+
+PT_LONG = 0x0003
+PT_ERROR = 0x000A
+PT_STRING8 = 0x001E
+PT_UNICODE = 0x001F
+PT_SYSTIME = 0x0040
+PT_BINARY = 0x0102
+
+# Property tags, the ids are arbitrary but unique
+TAGS = {}
+for index, (name, proptype) in enumerate([
+        ('PR_EC_WEBACCESS_SETTINGS_JSON', PT_STRING8), ('PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W', PT_UNICODE),
+        ('PR_LANGUAGE', PT_UNICODE), ('PR_MESSAGE_CLASS_W', PT_UNICODE), ('PR_SENDER_NAME_W', PT_UNICODE),
+        ('PR_SUBJECT_W', PT_UNICODE), ('PR_MESSAGE_DELIVERY_TIME', PT_SYSTIME), ('PR_CLIENT_SUBMIT_TIME', PT_SYSTIME),
+        ('PR_SENDER_EMAIL_ADDRESS', PT_UNICODE), ('PR_SUBJECT_PREFIX', PT_UNICODE), ('PR_RECEIVED_BY_NAME_W', PT_UNICODE),
+        ('PR_INTERNET_MESSAGE_ID_W', PT_UNICODE), ('PR_BODY', PT_UNICODE), ('PR_ENTRYID', PT_BINARY),
+        ('PR_ACCOUNT_W', PT_UNICODE), ('PR_DISPLAY_NAME_W', PT_UNICODE), ('PR_SMTP_ADDRESS_W', PT_UNICODE),
+        ('PR_TITLE_W', PT_UNICODE), ('PR_BUSINESS_TELEPHONE_NUMBER_W', PT_UNICODE),
+        ('PR_MOBILE_TELEPHONE_NUMBER_W', PT_UNICODE), ('PR_DEPARTMENT_NAME_W', PT_UNICODE),
+        ('PR_COMPANY_NAME_W', PT_UNICODE), ('PR_OFFICE_LOCATION_W', PT_UNICODE), ('PR_STREET_ADDRESS_W', PT_UNICODE),
+        ('PR_LOCALITY_W', PT_UNICODE), ('PR_POSTAL_CODE_W', PT_UNICODE), ('PR_COUNTRY_W', PT_UNICODE)]):
+    TAGS[name] = 0x10000000 + (index << 16) + proptype
+# The 8-bit and unicode variants of a property are the same property
+for name in ('PR_MESSAGE_CLASS', 'PR_SENDER_NAME', 'PR_SUBJECT', 'PR_RECEIVED_BY_NAME', 'PR_INTERNET_MESSAGE_ID'):
+    TAGS[name] = TAGS[name + '_W']
+PR_EC_RECIPIENT_HISTORY_JSON_W = 0X6773001F
+PR_EMS_AB_PROXY_ADDRESSES = 0x800f101f
+
+CONSTANTS = {
+    'KEEP_OPEN_READWRITE': 0x4,
+    'MAPI_ASSOCIATED': 0x40,
+    'MAPI_SEND_NO_RICH_INFO': 0x10000,
+    'MAPI_UNICODE': 0x80000000,
+    'MAPI_E_NOT_FOUND': 0x8004010F,
+    'RELOP_LT': 0,
+    'RELOP_LE': 1,
+    'RELOP_GT': 2,
+    'RELOP_GE': 3,
+    'RELOP_EQ': 4,
+    'RELOP_NE': 5,
+    'TBL_BATCH': 0x2,
+    'PT_LONG': PT_LONG,
+    'PT_ERROR': PT_ERROR,
+    'PT_STRING8': PT_STRING8,
+    'PT_UNICODE': PT_UNICODE,
+    'PT_SYSTIME': PT_SYSTIME,
+    'PT_BINARY': PT_BINARY,
+}
+
+
+def PROP_TYPE(proptag):
+    return proptag & 0xFFFF
+
+
+def PROP_TAG(proptype, propid):
+    return (propid << 16) | proptype
+
+
+class NotFoundError(Exception):
+    pass
+
+
+class MAPIErrorNetworkError(Exception):
+    pass
+
+
+class MAPIErrorEndOfSession(Exception):
+    pass
+
+
+"""
+Latency and call counters shared by all fake objects
+"""
+class Stats(object):
+    def __init__(self):
+        self.latency = 0
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+
+
+stats = Stats()
+
+
+class Prop(object):
+    def __init__(self, proptag, value):
+        self.proptag = proptag
+        self.value = value
+
+
+class SPropValue(object):
+    def __init__(self, ulPropTag, Value):
+        self.ulPropTag = ulPropTag
+        self.Value = Value
+
+
+"""
+Value of a property as the server returns it, 8-bit strings are converted to unicode
+"""
+def column_value(proptag, value):
+    if PROP_TYPE(proptag) == PT_UNICODE and isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class FileTime(object):
+    def __init__(self, unixtime):
+        self.unixtime = unixtime
+
+
+class SPropertyRestriction(object):
+    def __init__(self, relop, ulPropTag, lpProp):
+        self.relop = relop
+        self.ulPropTag = ulPropTag
+        self.lpProp = lpProp
+
+    def match(self, props):
+        if self.ulPropTag not in props:
+            return False
+        value, other = column_value(self.ulPropTag, props[self.ulPropTag]), self.lpProp.Value
+        if isinstance(value, FileTime):
+            value, other = value.unixtime, other.unixtime
+        return [value < other, value <= other, value > other, value >= other, value == other, value != other][self.relop]
+
+
+class SAndRestriction(object):
+    def __init__(self, lpRes):
+        self.lpRes = lpRes
+
+    def match(self, props):
+        return all(restriction.match(props) for restriction in self.lpRes)
+
+
+class SOrRestriction(object):
+    def __init__(self, lpRes):
+        self.lpRes = lpRes
+
+    def match(self, props):
+        return any(restriction.match(props) for restriction in self.lpRes)
+
+
+"""
+Contents table of a folder, the rows are read when the table is created
+"""
+class Table(object):
+    def __init__(self, items):
+        self.items = items
+        self.columns = []
+        self.position = 0
+
+    def SetColumns(self, columns, flags):
+        self.columns = columns
+
+    def Restrict(self, restriction, flags):
+        self.items = [item for item in self.items if restriction.match(item.props)]
+
+    def QueryRows(self, count, flags):
+        stats.call('QueryRows')
+        rows = []
+        for item in self.items[self.position:self.position + count]:
+            rows.append([SPropValue(proptag, column_value(proptag, item.props[proptag])) if proptag in item.props else
+                         SPropValue(PROP_TAG(PT_ERROR, proptag >> 16), CONSTANTS['MAPI_E_NOT_FOUND'])
+                         for proptag in self.columns])
+        self.position += count
+        return rows
+
+
+class PropObject(object):
+    def __init__(self, props=None):
+        self.props = props or {}
+
+    def prop(self, proptag):
+        stats.call('prop')
+        try:
+            return Prop(proptag, self.props[proptag])
+        except KeyError:
+            raise NotFoundError('no property with tag 0x%08x' % proptag)
+
+    def get_prop(self, proptag):
+        try:
+            return self.prop(proptag)
+        except NotFoundError:
+            return None
+
+    def create_prop(self, proptag, value):
+        stats.call('create_prop')
+        self.props[proptag] = value
+
+
+class Item(PropObject):
+    def __init__(self, props=None):
+        PropObject.__init__(self, props)
+        self.props.setdefault(TAGS['PR_ENTRYID'], os.urandom(16))
+
+    @property
+    def subject(self):
+        return self.props.get(TAGS['PR_SUBJECT'], '')
+
+    @property
+    def text(self):
+        return self.props.get(TAGS['PR_BODY'], '')
+
+
+"""
+MAPI message that is added to a folder on SaveChanges
+"""
+class MAPIMessage(object):
+    def __init__(self, folder):
+        self.folder = folder
+        self.props = {}
+
+    def SetProps(self, props):
+        for prop in props:
+            self.props[prop.ulPropTag] = prop.Value
+
+    def SaveChanges(self, flags):
+        stats.call('SaveChanges')
+        self.folder.add(Item(self.props))
+
+
+class Folder(object):
+    def __init__(self):
+        self._items = []
+        self.lock = threading.Lock()
+        self.mapiobj = self
+
+    def add(self, item):
+        with self.lock:
+            self._items.append(item)
+
+    def items(self):
+        stats.call('items')
+        with self.lock:
+            return iter(list(self._items))
+
+    def delete(self, item):
+        stats.call('delete')
+        with self.lock:
+            self._items.remove(item)
+
+    def CreateMessage(self, interface, flags):
+        return MAPIMessage(self)
+
+
+"""
+MAPI object of the root folder, the associated contents are those of root.associated
+"""
+class MAPIFolder(object):
+    def __init__(self, root):
+        self.root = root
+
+    def GetContentsTable(self, flags):
+        stats.call('GetContentsTable')
+        with self.root.associated.lock:
+            return Table(list(self.root.associated._items))
+
+    def DeleteMessages(self, entryids, uiparam, progress, flags):
+        stats.call('DeleteMessages')
+        entryids = set(entryids)
+        with self.root.associated.lock:
+            self.root.associated._items = [item for item in self.root.associated._items if item.props[TAGS['PR_ENTRYID']] not in entryids]
+
+
+class Root(object):
+    def __init__(self):
+        self.associated = Folder()
+        self.mapiobj = MAPIFolder(self)
+
+
+"""
+MAPI store object, used by manage_recipients
+"""
+class MAPIStore(object):
+    def __init__(self, store):
+        self.store = store
+
+    def SetProps(self, props):
+        for prop in props:
+            self.store.props[prop.ulPropTag] = prop.Value
+
+    def SaveChanges(self, flags):
+        stats.call('SaveChanges')
+
+
+class Store(PropObject):
+    def __init__(self):
+        PropObject.__init__(self)
+        self.root = Root()
+        self.mapiobj = MAPIStore(self)
+
+    def item(self, entryid):
+        stats.call('item')
+        entryid = binascii.unhexlify(entryid)
+        for item in self.root.associated._items:
+            if item.props[TAGS['PR_ENTRYID']] == entryid:
+                return item
+        raise NotFoundError('no item with entryid %s' % entryid)
+
+
+class User(PropObject):
+    def __init__(self, name, email, fullname):
+        PropObject.__init__(self)
+        self.name = name
+        self.email = email
+        self.fullname = fullname
+        self.store = Store()
+        self.server = None
+
+
+class AddressBook(object):
+    def CreateOneOff(self, name, addrtype, email, flags):
+        stats.call('CreateOneOff')
+        return b'\x00\x00\x00\x00\x81\x2b\x1f\xa4\xbe\xa3\x10\x19\x9d\x6e\x00\xdd\x01\x0f\x54\x02' + \
+            (name + '\x00' + addrtype + '\x00' + email + '\x00').encode('utf-16-le')
+
+
+class Group(object):
+    def __init__(self, name):
+        self.name = name
+        self.members = []
+
+    def users(self):
+        stats.call('group_users')
+        return iter(list(self.members))
+
+
+# All users and groups of the fake server, keyed on the name
+USERS = {}
+GROUPS = {}
+
+
+"""
+Global address book container with all users
+"""
+class GAB(object):
+    def GetContentsTable(self, flags):
+        stats.call('GetContentsTable')
+        return Table([USERS[name] for name in sorted(USERS)])
+
+
+class Server(object):
+    def __init__(self, options=None, **kwargs):
+        stats.call('logon')
+        self.options = options
+        self.ab = AddressBook()
+        self.gab = GAB()
+
+    def users(self, names=None):
+        stats.call('users')
+        for name in (names or sorted(USERS)):
+            yield self.user(name)
+
+    def group(self, name):
+        try:
+            group = GROUPS[name]
+        except KeyError:
+            raise NotFoundError("no such group: '%s'" % name)
+        for user in group.members:
+            user.server = self
+        return group
+
+    def user(self, name):
+        try:
+            user = USERS[name]
+        except KeyError:
+            raise NotFoundError("no such user: '%s'" % name)
+        user.server = self
+        return user
+
+
+"""
+Option parser with the python-kopano options used by the tools
+"""
+def parser(options='cskpUPufm', usage=None):
+    parser = optparse.OptionParser(usage=usage)
+    known = {
+        'c': ('-c', '--config', dict(dest='config_file')),
+        's': ('-s', '--server-socket', dict(dest='server_socket')),
+        'k': ('-k', '--ssl-key', dict(dest='sslkey_file')),
+        'p': ('-p', '--ssl-pass', dict(dest='sslkey_pass')),
+        'U': ('-U', '--auth-user', dict(dest='auth_user')),
+        'P': ('-P', '--auth-pass', dict(dest='auth_pass')),
+        'u': ('-u', '--user', dict(dest='users', action='append', default=[])),
+        'f': ('-f', '--folder', dict(dest='folders', action='append', default=[])),
+        'm': ('-m', '--modify', dict(dest='modify', action='store_true')),
+    }
+    for option in options:
+        if option in known:
+            short, long, kwargs = known[option]
+            parser.add_option(short, long, **kwargs)
+    return parser
+
+
+"""
+Register the fake kopano and MAPI modules
+"""
+def install():
+    kopano = types.ModuleType('kopano')
+    kopano.Server = Server
+    kopano.parser = parser
+    kopano.NotFoundError = NotFoundError
+    errors = types.ModuleType('kopano.errors')
+    errors.NotFoundError = NotFoundError
+    kopano.errors = errors
+
+    mapi = types.ModuleType('MAPI')
+    tags = types.ModuleType('MAPI.Tags')
+    util = types.ModuleType('MAPI.Util')
+    mapitime = types.ModuleType('MAPI.Time')
+    mapitime.unixtime = FileTime
+    mapitime.FileTime = FileTime
+    for name, value in list(TAGS.items()) + list(CONSTANTS.items()):
+        setattr(tags, name, value)
+        setattr(util, name, value)
+    for function in (SPropValue, SPropertyRestriction, SAndRestriction, SOrRestriction, PROP_TYPE, PROP_TAG,
+                     MAPIErrorNetworkError, MAPIErrorEndOfSession):
+        setattr(util, function.__name__, function)
+    util.MAPI = mapi
+    mapi.Tags = tags
+    mapi.Util = util
+    mapi.Time = mapitime
+
+    sys.modules.update({
+        'kopano': kopano, 'kopano.errors': errors,
+        'MAPI': mapi, 'MAPI.Tags': tags, 'MAPI.Util': util, 'MAPI.Time': mapitime,
+    })
+
+
+"""
+Add a user to the fake server
+
+:param name: The username
+:param settings: Serialized WebApp settings
+:param persistent_settings: Serialized persistent WebApp settings
+:param recipients: Serialized recipient history
+:param certificates: Number of S/MIME certificates in the associated folder
+:param aliases: Number of alias addresses
+:param groups: Names of the groups of the user
+:return: The user
+"""
+def add_user(name, settings=None, persistent_settings=None, recipients=None, certificates=0, aliases=0, groups=()):
+    email = '%s@example.com' % name
+    user = User(name, email, name.title())
+    user.props[TAGS['PR_LANGUAGE']] = 'nl_NL.UTF-8'
+    user.props[TAGS['PR_ACCOUNT_W']] = name
+    user.props[TAGS['PR_DISPLAY_NAME_W']] = user.fullname
+    user.props[TAGS['PR_SMTP_ADDRESS_W']] = email
+    user.props[TAGS['PR_TITLE_W']] = 'Engineer'
+    user.props[TAGS['PR_BUSINESS_TELEPHONE_NUMBER_W']] = '+31 10 %07d' % len(USERS)
+    user.props[TAGS['PR_COMPANY_NAME_W']] = 'Example & Co'
+    user.props[PR_EMS_AB_PROXY_ADDRESSES] = ['SMTP:%s' % email] + ['smtp:%s.%d@example.com' % (name, i) for i in range(aliases)]
+    if settings is not None:
+        user.store.props[TAGS['PR_EC_WEBACCESS_SETTINGS_JSON']] = settings.encode('utf-8')
+    if persistent_settings is not None:
+        user.store.props[TAGS['PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W']] = persistent_settings
+    if recipients is not None:
+        user.store.props[PR_EC_RECIPIENT_HISTORY_JSON_W] = recipients
+
+    now = time.time()
+    for i in range(certificates):
+        messageclass = 'WebApp.Security.Private' if i % 2 == 0 else 'WebApp.Security.Public'
+        user.store.root.associated.add(Item({
+            TAGS['PR_SUBJECT']: email,
+            TAGS['PR_MESSAGE_CLASS_W']: messageclass,
+            TAGS['PR_SENDER_NAME_W']: str(1000 + i),
+            TAGS['PR_MESSAGE_DELIVERY_TIME']: FileTime(now + 365 * 86400 * (1 if i % 3 else -1)),
+            TAGS['PR_CLIENT_SUBMIT_TIME']: FileTime(now - 365 * 86400),
+            TAGS['PR_RECEIVED_BY_NAME']: binascii.hexlify(os.urandom(20)).decode(),
+            TAGS['PR_BODY']: base64.b64encode(os.urandom(4096)).decode('ascii'),
+        }))
+    for group in groups:
+        GROUPS.setdefault(group, Group(group)).members.append(user)
+    USERS[name] = user
+    return user
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Micro-benchmark of the JSON parsing used by the WebApp tools
+
+Generates WebApp settings documents of realistic sizes (a big state subtree,
+signatures with inline images, sendas addresses) and compares parsing with
+json and orjson. Both must give the same result.
+
+Usage: python3 json_codec.py [--rounds N]
+"""
+import base64
+import json
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+"""
+Generate WebApp settings
+
+:param state_items: Number of entries in the state subtree
+:param signatures: Number of signatures
+:param image_size: Size in bytes of the inline image of every signature
+:param sendas: Number of sendas addresses
+:return: Settings document
+"""
+def generate_settings(state_items, signatures, image_size, sendas):
+    rnd = random.Random(state_items + signatures)
+    state = {}
+    for i in range(state_items):
+        state['models.grid.%d' % i] = {
+            'columns': [{'id': 'column%d' % c, 'width': rnd.randint(20, 300), 'hidden': rnd.random() < 0.3} for c in range(6)],
+            'sort': {'field': 'message_delivery_time', 'direction': 'DESC'},
+            'group': None,
+        }
+    image = base64.b64encode(os.urandom(image_size)).decode('ascii')
+    all_signatures = {}
+    for i in range(signatures):
+        all_signatures[str(1615141312112 + i)] = {
+            'name': 'Signature %d' % i,
+            'content': '<p>Kind regards,</p><p>Jörg Müller</p><img src="data:image/png;base64,%s">' % image,
+            'isHTML': True,
+        }
+    return {'settings': {'zarafa': {'v1': {
+        'main': {'language': 'nl_NL.UTF-8', 'active_theme': 'dark', 'reminder': {'polling_interval': 30}},
+        'contexts': {
+            'mail': {
+                'signatures': {'all': all_signatures},
+                'sendas': [{'display_name': 'Alias %d' % i, 'smtp_address': 'alias%d@example.com' % i, 'rowid': i,
+                            'entryid': os.urandom(40).hex(), 'reply_mail': False, 'new_mail': False, 'forward_mail': False}
+                           for i in range(sendas)],
+                'safe_senders_list': ['example%d.com' % i for i in range(50)],
+            },
+            'calendar': {'default_zoom_level': 30, 'free_busy_range': 12},
+        },
+        'state': state,
+    }}}}
+
+
+DOCUMENTS = [
+    ('small', dict(state_items=20, signatures=1, image_size=0, sendas=2)),
+    ('state heavy', dict(state_items=5000, signatures=2, image_size=2000, sendas=20)),
+    ('signature heavy', dict(state_items=200, signatures=5, image_size=400000, sendas=10)),
+]
+
+
+def measure(function, data, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(data)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--rounds", dest="rounds", action="store", type="int", default=20, help="Number of rounds per measurement")
+    options, args = parser.parse_args()
+
+    if not orjson:
+        print('orjson is not installed, only measuring json')
+
+    print('{:<16} {:>10} {:>14} {:>14} {:>8}'.format('document', 'size', 'json (ms)', 'orjson (ms)', 'speedup'))
+    for name, params in DOCUMENTS:
+        data = json.dumps(generate_settings(**params)).encode('utf-8')
+        json_time = measure(json.loads, data, options.rounds)
+        if orjson:
+            if orjson.loads(data) != json.loads(data):
+                print('{}: orjson result differs from json'.format(name))
+                sys.exit(1)
+            orjson_time = measure(orjson.loads, data, options.rounds)
+            print('{:<16} {:>10} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(name, len(data), json_time * 1000, orjson_time * 1000, json_time / orjson_time))
+        else:
+            print('{:<16} {:>10} {:>14.2f} {:>14} {:>8}'.format(name, len(data), json_time * 1000, '-', '-'))
+
+
+if __name__ == '__main__':
+    main()
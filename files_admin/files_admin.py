@@ -1,5 +1,15 @@
 #!/usr/bin/env python3
+import base64
+import contextlib
+import functools
+import io
+import os
+import re
+import socketserver
+import stat
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from configobj import ConfigObj
 import uuid
 from MAPI.Util import *
@@ -12,29 +22,128 @@ try:
 except ImportError:
     import simplejson as json
 
+# Use orjson for parsing if available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Use cryptography to encode the account settings if available, otherwise deencode.php is run for every value
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, modes
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+    except ImportError:
+        from cryptography.hazmat.primitives.ciphers.algorithms import TripleDES
+except ImportError:
+    Cipher = None
+
+FILES_CONFIG = '/etc/kopano/webapp/config-files.php'
+
+# Errors after which the server connection of the daemon is not reused
+CONNECTION_ERRORS = (MAPIErrorNetworkError, MAPIErrorEndOfSession)
+
+
+def read_files_config(filename):
+    """Read FILES_PASSWORD_KEY and FILES_PASSWORD_IV from the config of the Files plugin"""
+    with open(filename) as f:
+        config = f.read()
+    values = {}
+    for name in ('FILES_PASSWORD_KEY', 'FILES_PASSWORD_IV'):
+        match = re.search(r'''define\(\s*['"]%s['"]\s*,\s*(['"])((?:\\.|(?!\1).)*)\1\s*\)''' % name, config)
+        if not match:
+            raise ValueError('{} is not defined in {}'.format(name, filename))
+        values[name] = re.sub(r'\\([\\\'"])', r'\1', match.group(2)).encode('utf-8')
+    return values['FILES_PASSWORD_KEY'], values['FILES_PASSWORD_IV']
+
+
+class Encoder(object):
+    """des-ede3-cbc with base64 output, the same as openssl_encrypt in deencode.php"""
+
+    def __init__(self, key, iv):
+        # openssl_encrypt pads a short key or iv with NUL bytes and ignores the rest of a long one
+        self.key = key[:24].ljust(24, b'\0')
+        self.iv = iv[:8].ljust(8, b'\0')
+
+    def encode(self, value):
+        value = value.encode('utf-8')
+        # PKCS#7 padding
+        padding = 8 - len(value) % 8
+        value += bytes([padding]) * padding
+        encryptor = Cipher(TripleDES(self.key), modes.CBC(self.iv)).encryptor()
+        return base64.b64encode(encryptor.update(value) + encryptor.finalize())
+
+    def decode(self, value):
+        decryptor = Cipher(TripleDES(self.key), modes.CBC(self.iv)).decryptor()
+        value = decryptor.update(base64.b64decode(value)) + decryptor.finalize()
+        return value[:-value[-1]].decode('utf-8')
+
+
+encoder = None
 
+
+def load_encoder(filename=FILES_CONFIG):
+    """Encode in-process with the key and iv of the Files plugin, deencode.php is used when that is not possible"""
+    global encoder
+    encoder = None
+    if Cipher:
+        try:
+            encoder = Encoder(*read_files_config(filename))
+        except (IOError, ValueError) as e:
+            print('Can not read the Files password key from {}, using deencode.php: {}'.format(filename, e), file=sys.stderr)
+    encode.cache_clear()
+
+
+# Most values, like the server address and the account id, are the same for every user
+@functools.lru_cache(maxsize=4096)
 def encode(value):
+    if encoder:
+        return encoder.encode(value)
     output = subprocess.check_output(["php", "deencode.php", "encode", value])
     return output.strip()
 
 
-def opt_args():
+def decode(value):
+    if encoder:
+        return encoder.decode(value)
+    output = subprocess.check_output(["php", "deencode.php", "decode", value])
+    return output.strip().decode('utf-8')
+
+
+def opt_args(args=None):
     parser = kopano.parser('skpcfm')
     parser.add_option("--user", dest="user", action="store", help="username")
+    parser.add_option("--all-users", dest="all_users", action="store_true", help="Run for all users")
+    parser.add_option("--group", dest="group", action="store", help="Run for the users of a group")
+    parser.add_option("--jobs", dest="jobs", action="store", type="int", metavar="N",
+                      help="Number of users to process in parallel")
     parser.add_option("--ssl", dest="ssl", action="store_true", help="Use localhost on port 443")
     parser.add_option("--hostname", dest="hostname", action="store", help="hostname")
 
     parser.add_option("--file", dest="file", default=[], action="store", help="config file(s) separate by ',' ")
     parser.add_option("--default", dest="default", action="store_true",
                       help="use default user and password in the configfile")
+    parser.add_option("--files-config", dest="files_config", action="store", default=FILES_CONFIG,
+                      help="config of the Files plugin with the password key, default %s" % FILES_CONFIG)
+    parser.add_option("--daemon", dest="daemon", action="store", metavar="SOCKET",
+                      help="Keep server connections open and handle requests on a Unix socket")
+
+    return parser.parse_args(args)
+
 
-    return parser.parse_args()
+def json_loads(data):
+    """Parse JSON with orjson when available, it gives the same result as json.loads"""
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data)
 
 
 def read_settings(user):
     try:
-        mapisettings = user.store.prop(PR_EC_WEBACCESS_SETTINGS_JSON).value.decode('utf-8')
-        settings = json.loads(mapisettings)
+        settings = json_loads(user.store.prop(PR_EC_WEBACCESS_SETTINGS_JSON).value)
     except Exception as e:
         print('{}: Has no or no valid WebApp settings creating empty config tree'.format(user.name))
         settings = json.loads('{"settings": {"zarafa": {"v1": {"contexts": {"mail": {}}}}}}')
@@ -48,97 +157,254 @@ def write_settings(user, setting):
         print('{}: Error Writing WebApp settings for user: {}'.format(e, user.name))
 
 
-def files(options):
-    filesjson = {'accounts': {}}
+BACKEND_FEATURES = {
+    'ftp': {
+        "Streaming": "true", },
+    'webdav': {
+        "Quota": "true",
+        "VersionInfo": "true"},
+    'owncloud': {
+        "Quota": "true",
+        "Sharing": "true",
+        "VersionInfo": "true"},
+    'smb': {
+        "Quota": "true",
+        "Streaming": "true",
+        "VersionInfo": "true"},
+}
+
+
+# Namespace of the account ids, the id is derived from the user and the config of the account
+ACCOUNT_NAMESPACE = uuid.UUID('5b0c7e52-3f0e-4c1b-9d4a-2a6f1c8e9b37')
 
-    files = options.file.split(',')
-    for file in files:
+
+def load_accounts(options):
+    """Parse the config files once, the values that are the same for every user are encoded here"""
+    accounts = []
+    for file in options.file.split(','):
         configfile = ConfigObj(file)
-        
+
         # Check if the settings section key is present in the file
         try:
-            value = configfile['setting']
+            setting = configfile['setting']
         except KeyError:
             print('Setting does not exist in', file)
             continue
-        
-        if configfile['setting'].as_bool('use_zarafa_credentials'):
-            username = options.user
+
+        if 'local' in file and options.ssl:
+            port = '443'
+            address = options.hostname
+            ssl = 'true'
         else:
-            username = configfile['setting'].get('default_user', 'does not matter')
-        password = encode(configfile['setting'].get('default_password', 'does not matter'))
-        backendoptions = {
-            'ftp': {"backend_features": {
-                "Streaming": "true", }},
-            'webdav': {"backend_features": {
-                "Quota": "true",
-                "VersionInfo": "true"}},
-            'owncloud': {"backend_features": {
-                "Quota": "true",
-                "Sharing": "true",
-                "VersionInfo": "true"}},
-            'smb': {"backend_features": {
-                "Quota": "true",
-                "Streaming": "true",
-                "VersionInfo": "true"}},
-        }
+            port = setting['server_port']
+            address = setting['server_address']
+            ssl = setting['server_ssl']
 
-        if file == 'seafile.cfg':
-            password = encode(options.user)
-            username = kopano.Server(options).user(options.user).email
-
-        if 'local' in file:
-            if options.ssl:
-                port = '443'
-                address = options.hostname
-                ssl = 'true'
-            else:
-                port = configfile['setting']['server_port']
-                address = configfile['setting']['server_address']
-                ssl = configfile['setting']['server_ssl']
+        use_zarafa_credentials = setting.as_bool('use_zarafa_credentials')
+        accounts.append({
+            'identity': '\0'.join((os.path.basename(file), setting['name'], setting['type'])),
+            'seafile': file == 'seafile.cfg',
+            'use_zarafa_credentials': use_zarafa_credentials,
+            'user': None if use_zarafa_credentials else encode(setting.get('default_user', 'does not matter')).decode('utf-8'),
+            'password': encode(setting.get('default_password', 'does not matter')).decode('utf-8'),
+            'server_path': encode(setting['server_path']).decode('utf-8'),
+            'workgroup': encode(setting['workgroup']).decode('utf-8'),
+            'server_address': encode(address).decode('utf-8'),
+            'server_ssl': ssl,
+            'current_account_id': encode('d4cacda458a2a26c301f2b7d75ada530').decode('utf-8'),
+            'server_port': encode(port).decode('utf-8'),
+            'server_pasv': setting['server_pasv'] if setting['type'].lower() == 'ftp' else None,
+            'name': setting['name'],
+            'backend': setting['type'],
+            'backend_features': BACKEND_FEATURES[setting['type'].lower()],
+        })
+    return accounts
+
+
+def files(options, server=None, accounts=None, user=None):
+    if accounts is None:
+        accounts = load_accounts(options)
+    username = user.name if user else options.user
+    filesjson = {'accounts': {}}
+
+    for account in accounts:
+        if account['seafile']:
+            password = encode(username).decode('utf-8')
+            email = user.email if user else (server or kopano.Server(options)).user(username).email
+            account_user = encode(email).decode('utf-8')
         else:
-            port = configfile['setting']['server_port']
-            address = configfile['setting']['server_address']
-            ssl = configfile['setting']['server_ssl']
-        id = str(uuid.uuid4())
+            password = account['password']
+            account_user = account['user'] or encode(username).decode('utf-8')
+        id = str(uuid.uuid5(ACCOUNT_NAMESPACE, username + '\0' + account['identity']))
 
         filesjson['accounts'][id] = {
             "status": "ok",
             "backend_config": {
-                "server_path": encode(configfile['setting']['server_path']).decode('utf-8'),
-                "workgroup": encode(configfile['setting']['workgroup']).decode('utf-8'),
-                "server_address": encode(address).decode('utf-8'),
-                "server_ssl": ssl,
-                "current_account_id": encode('d4cacda458a2a26c301f2b7d75ada530').decode('utf-8'),
-                "use_zarafa_credentials": configfile['setting'].as_bool('use_zarafa_credentials'),
-                "user": encode(username).decode('utf-8'),
-                "password": password.decode('utf-8'),
-                "server_port": encode(port).decode('utf-8')
+                "server_path": account['server_path'],
+                "workgroup": account['workgroup'],
+                "server_address": account['server_address'],
+                "server_ssl": account['server_ssl'],
+                "current_account_id": account['current_account_id'],
+                "use_zarafa_credentials": account['use_zarafa_credentials'],
+                "user": account_user,
+                "password": password,
+                "server_port": account['server_port']
             },
             "cannot_change": False,
-            "name": configfile['setting']['name'],
+            "name": account['name'],
             "status_description": "Account is ready to use.",
             "id": id,
-            "backend_features": backendoptions[configfile['setting']['type'].lower()]['backend_features'],
-            "backend": configfile['setting']['type']
+            "backend_features": account['backend_features'],
+            "backend": account['backend']
         }
 
-        if configfile['setting']['type'].lower() == 'ftp':
-            filesjson['accounts'][id]['backend_config']['server_pasv'] = configfile['setting']['server_pasv']
+        if account['server_pasv'] is not None:
+            filesjson['accounts'][id]['backend_config']['server_pasv'] = account['server_pasv']
 
     return filesjson
 
 
-def main():
-    options, args = opt_args()
+def merge_accounts(current, filesjson):
+    """Add the accounts to the existing Files settings. An account only replaces the account with the
+    same (stable) id, other accounts of the user are kept, also when they have the same name"""
+    merged = dict(current)
+    accounts = dict(current.get('accounts') or {})
+    accounts.update(filesjson['accounts'])
+    merged['accounts'] = accounts
+    return merged
 
-    server = kopano.Server(options)
-    user = server.user(options.user)
+
+def inject(server, options, user=None, accounts=None):
+    """Inject the accounts, returns False when the settings of the user did not change"""
+    if user is None:
+        user = server.user(options.user)
     webappsettings = read_settings(user)
     if not webappsettings['settings']['zarafa']['v1'].get('plugins'):
         webappsettings['settings']['zarafa']['v1']['plugins'] = {}
-    webappsettings['settings']['zarafa']['v1']['plugins']['files'] = files(options)
+    plugins = webappsettings['settings']['zarafa']['v1']['plugins']
+    current = plugins.get('files') or {}
+    merged = merge_accounts(current, files(options, server, accounts, user))
+    if merged == current:
+        return False
+    plugins['files'] = merged
     write_settings(user, json.dumps(webappsettings))
+    return True
+
+
+def selected_users(server, options):
+    if options.all_users:
+        return server.users()
+    if options.group:
+        return server.group(options.group).users()
+    return [server.user(options.user)]
+
+
+def provision(server, options):
+    """Inject the accounts for the selected users, returns the number of users that failed"""
+    accounts = load_accounts(options)
+
+    def inject_user(user):
+        try:
+            return 'written' if inject(server, options, user, accounts) else 'unchanged'
+        except Exception as e:
+            print('{}: Error injecting the Files accounts: {}'.format(user.name, e))
+            return 'failed'
+
+    if options.jobs and options.jobs > 1:
+        # The server connection is shared, the workers only overlap the server round trips
+        with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            results = list(executor.map(inject_user, selected_users(server, options)))
+    else:
+        results = [inject_user(user) for user in selected_users(server, options)]
+    print('Files accounts written for {} users, {} users unchanged'.format(results.count('written'), results.count('unchanged')))
+    return results.count('failed')
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Handle a request of the form {"args": ["--user", "john", "--file", "owncloud.cfg"]},
+    the reply is {"status": 0, "output": "..."}"""
+
+    def handle(self):
+        buffer = io.StringIO()
+        with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(buffer):
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                status = self.server.run_request([str(arg) for arg in request.get('args', [])])
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code)
+                    status = 1
+            except Exception as e:
+                print('Error: {!r}'.format(e))
+                status = 1
+        self.wfile.write((json.dumps({'status': status, 'output': buffer.getvalue()}) + '\n').encode('utf-8'))
+
+
+def daemon(options):
+    """Handle requests on a Unix socket one at a time until interrupted, the server
+    connection is kept open between requests"""
+    # Log on at startup, so configuration problems show up right away
+    connection = {'server': kopano.Server(options)}
+
+    def run_request(args):
+        request, args = opt_args(args)
+        if request.daemon:
+            print('--daemon can not be used in a daemon request')
+            return 1
+        if not (request.user or request.all_users or request.group) or not request.file:
+            print('Please use:\n --user <username> --file <config file(s)>')
+            return 1
+        if connection['server'] is None:
+            connection['server'] = kopano.Server(options)
+        try:
+            failed = provision(connection['server'], request)
+        except CONNECTION_ERRORS:
+            # A broken connection is not reused, other errors (e.g. an unknown user) leave it usable
+            connection['server'] = None
+            raise
+        return 1 if failed else 0
+
+    # Only a socket left behind by an earlier daemon is removed
+    if os.path.lexists(options.daemon):
+        if not stat.S_ISSOCK(os.lstat(options.daemon).st_mode):
+            print('%s exists and is not a socket' % options.daemon)
+            sys.exit(1)
+        os.unlink(options.daemon)
+    # Only the owner may connect, the daemon runs with the credentials of the admin.
+    # The socket is created without permissions for others.
+    umask = os.umask(0o077)
+    try:
+        socket_server = socketserver.UnixStreamServer(options.daemon, DaemonHandler)
+    finally:
+        os.umask(umask)
+    socket_server.run_request = run_request
+
+    print('Waiting for requests on {}'.format(options.daemon))
+    try:
+        socket_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket_server.server_close()
+        os.unlink(options.daemon)
+
+
+def main():
+    options, args = opt_args()
+    load_encoder(options.files_config)
+
+    if options.daemon:
+        daemon(options)
+        return
+
+    if not (options.user or options.all_users or options.group) or not options.file:
+        print('Please use:\n %s --user <username> --file <config file(s)>\n or --all-users or --group <group> instead of --user' % (sys.argv[0]))
+        sys.exit(1)
+
+    if provision(kopano.Server(options), options):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
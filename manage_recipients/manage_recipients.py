@@ -4,80 +4,297 @@
 import kopano
 from kopano.errors import NotFoundError
 from MAPI.Util import *
+import contextlib
+import io
 import json
+import os
+import re
+import socketserver
+import stat
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+# Use orjson for parsing if available
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def opt_args():
+# Use an Aho-Corasick automaton for the substring patterns if available
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Result of manage() for a user without recipient history to backup
+SKIPPED = 'skipped'
+
+# Errors after which the server connection of the daemon is not reused
+CONNECTION_ERRORS = (MAPIErrorNetworkError, MAPIErrorEndOfSession)
+
+
+def json_loads(data):
+    """Parse JSON with orjson when available, it gives the same result as json.loads"""
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data)
+
+
+# Flags at the start of a regex, e.g. (?i), and references to groups, which can not be combined
+REGEX_GLOBAL_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+REGEX_REFERENCES = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?\(')
+
+
+def combinable_regex(regex):
+    """The regex as a group that can be combined with other regexes into one regex, or None when
+    it has to be compiled on its own. Flags at the start become scoped flags, (?i)x becomes (?i:x)."""
+    if REGEX_REFERENCES.search(regex):
+        return None
+    flags = ''
+    match = REGEX_GLOBAL_FLAGS.match(regex)
+    if match:
+        flags, regex = match.group(1), regex[match.end():]
+        # Verbose comments would hide the end of the group, only these flags are scoped
+        if not set(flags) <= set('aims'):
+            return None
+    if REGEX_GLOBAL_FLAGS.search(regex):
+        return None
+    group = '(?%s:%s)' % (flags, regex)
+    try:
+        re.compile(group)
+    except re.error:
+        return None
+    return group
+
+
+class RecipientMatcher(object):
+    """All removal patterns compiled into one matcher, a recipient is checked in one pass
+
+    Exact addresses and domains are looked up in sets, substrings are searched with
+    one Aho-Corasick automaton (or one combined regex) and the regexes are combined
+    into one regex. Only regexes with group references or flags that can not be
+    scoped are compiled on their own."""
+
+    def __init__(self, substrings=(), exact=(), domains=(), regexes=()):
+        self.exact = set(address.lower() for address in exact)
+        self.domains = set(domain.lower().lstrip('@') for domain in domains)
+        self.automaton = None
+        self.substring = None
+        substrings = [substring for substring in substrings if substring]
+        if substrings and ahocorasick:
+            self.automaton = ahocorasick.Automaton()
+            for substring in substrings:
+                self.automaton.add_word(substring, substring)
+            self.automaton.make_automaton()
+        elif substrings:
+            self.substring = re.compile('|'.join(re.escape(substring) for substring in sorted(substrings, key=len, reverse=True)))
+        combined = []
+        self.regexes = []
+        for regex in regexes:
+            group = combinable_regex(regex)
+            if group is None:
+                self.regexes.append(re.compile(regex))
+            else:
+                combined.append(group)
+        self.regex = re.compile('|'.join(combined)) if combined else None
+
+    def match_address(self, address):
+        address = address.lower()
+        if address in self.exact:
+            return True
+        if self.domains and '@' in address:
+            # The domain itself and all its parent domains
+            domain = address.rsplit('@', 1)[1]
+            while domain:
+                if domain in self.domains:
+                    return True
+                domain = domain.partition('.')[2]
+        return False
+
+    def match_text(self, text):
+        if self.automaton is not None and next(self.automaton.iter(text), None) is not None:
+            return True
+        if self.substring and self.substring.search(text):
+            return True
+        if self.regex and self.regex.search(text):
+            return True
+        return any(regex.search(text) for regex in self.regexes)
+
+    def match(self, rec):
+        smtp_address = rec.get('smtp_address') or ''
+        email_address = rec.get('email_address') or ''
+        if (self.exact or self.domains) and (self.match_address(smtp_address) or self.match_address(email_address)):
+            return True
+        return self.match_text(rec.get('display_name') or '') or self.match_text(smtp_address) or self.match_text(email_address)
+
+
+def read_patterns(filename):
+    """Read a pattern file, one pattern per line:
+
+    exact:john@example.com  the address of the recipient is john@example.com
+    domain:example.com      the address is in example.com or one of its subdomains
+    regex:^info@            the regex matches the name or an address of the recipient
+    example                 the name or an address of the recipient contains example
+
+    Empty lines and lines starting with # are ignored."""
+    patterns = {'substrings': [], 'exact': [], 'domains': [], 'regexes': []}
+    kinds = {'exact': 'exact', 'domain': 'domains', 'regex': 'regexes', 'substring': 'substrings'}
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, separator, pattern = line.partition(':')
+            if separator and kind in kinds:
+                if kind == 'regex':
+                    try:
+                        re.compile(pattern)
+                    except re.error as e:
+                        raise ValueError('%s line %d: invalid regex %s: %s' % (filename, number, pattern, e))
+                patterns[kinds[kind]].append(pattern)
+            else:
+                patterns['substrings'].append(line)
+    return patterns
+
+
+def build_matcher(options):
+    """Matcher for --remove and the patterns in --remove-file"""
+    patterns = {'substrings': [], 'exact': [], 'domains': [], 'regexes': []}
+    if options.removefile:
+        patterns = read_patterns(options.removefile)
+    if options.remove:
+        patterns['substrings'].append(options.remove)
+    return RecipientMatcher(**patterns)
+
+
+def normalized_address(rec):
+    """The address a recipient is deduplicated on"""
+    return (rec.get('smtp_address') or rec.get('email_address') or '').strip().lower()
+
+
+def compact_recipients(recipients, max_recipients=None, max_age=None):
+    """Merge the recipients with the same address, drop the ones not used in max_age days and
+    keep the max_recipients most used and most recently used recipients, in their original order"""
+    merged = {}
+    order = []
+    for rec in recipients:
+        address = normalized_address(rec)
+        if not address:
+            # Nothing to merge on, keep it as is
+            address = len(order)
+        other = merged.get(address)
+        if other is None:
+            merged[address] = rec
+            order.append(address)
+            continue
+        # Keep the most recently used entry with the highest count of both
+        newest, oldest = (rec, other) if rec.get('last_used', 0) >= other.get('last_used', 0) else (other, rec)
+        newest = dict(newest)
+        newest['count'] = max(newest.get('count', 0), oldest.get('count', 0))
+        merged[address] = newest
+
+    if max_age is not None:
+        oldest_used = time.time() - max_age * 86400
+        order = [address for address in order if merged[address].get('last_used', 0) >= oldest_used]
+
+    if max_recipients is not None and len(order) > max_recipients:
+        ranked = sorted(order, key=lambda address: (merged[address].get('count', 0), merged[address].get('last_used', 0)), reverse=True)
+        keep = set(ranked[:max_recipients])
+        order = [address for address in order if address in keep]
+
+    return [merged[address] for address in order]
+
+
+def opt_args(args=None):
     parser = kopano.parser('skpcfm')
     parser.add_option("--user", dest="user", action="store", help="Run script for user")
+    parser.add_option("--users", dest="users", action="store", help="Run script for these users, separated by ','")
+    parser.add_option("--all-users", dest="all_users", action="store_true", help="Run script for all users")
+    parser.add_option("--jobs", dest="jobs", action="store", type="int", metavar="N", help="Number of users to process in parallel")
     parser.add_option("--list", dest="list", action="store_true", help="List recipients history")
     parser.add_option("--backup", dest="backup", action="store_true", help="Backup recipients history")
     parser.add_option("--restore", dest="restore", action="store_true", help="Restore recipients history")
     parser.add_option("--restore-file", dest="restorefile", action="store", help="Restore from an other file then username.json")
+    parser.add_option("--export", dest="exportfile", action="store", metavar="FILE",
+                      help="Export the recipient history of the users as JSON lines to FILE, - for stdout")
+    parser.add_option("--import", dest="importfile", action="store", metavar="FILE",
+                      help="Import the recipient histories of an --export from FILE, - for stdin")
     parser.add_option("--remove", dest="remove", action="store", help="Remove recipients ")
+    parser.add_option("--remove-file", dest="removefile", action="store",
+                      help="Remove the recipients that match a pattern in the file, one exact:<address>, domain:<domain>, regex:<regex> or substring per line")
     parser.add_option("--remove-all", dest="removeall", action="store_true", help="Remove complete recipients history")
+    parser.add_option("--compact", dest="compact", action="store_true",
+                      help="Merge recipients with the same address and apply --max-recipients and --max-age")
+    parser.add_option("--max-recipients", dest="max_recipients", action="store", type="int", metavar="N",
+                      help="With --compact, keep only the N most used recipients")
+    parser.add_option("--max-age", dest="max_age", action="store", type="int", metavar="DAYS",
+                      help="With --compact, remove recipients not used in DAYS days")
     parser.add_option("--dry-run", dest="dryrun", action="store_true", help="Test script")
+    parser.add_option("--daemon", dest="daemon", action="store", metavar="SOCKET",
+                      help="Keep server connections open and handle requests on a Unix socket")
 
-    return parser.parse_args()
-
-
-def main():
-    options, args = opt_args()
+    return parser.parse_args(args)
 
-    if not options.user:
-        print('Please use:\n %s --user <username>' % (sys.argv[0]))
-        sys.exit(0)
 
-    user = kopano.Server(options).user(options.user)
+def manage(user, options, matcher=None):
+    """Run the requested action for the user, returns the number of removed recipients, SKIPPED when there
+    is nothing to backup or None on failure"""
     try:
         webapp = user.store.prop(0X6773001F).value
     except NotFoundError:
-        webapp = dict(recipients=[])
+        webapp = '{"recipients": []}'
 
-    webapp = json.loads(webapp)
+    size = len(webapp if isinstance(webapp, bytes) else webapp.encode('utf-8'))
+    webapp = json_loads(webapp)
 
     if options.backup:
         if len(webapp['recipients']) == 0:
             print('Property PR_EC_RECIPIENT_HISTORY_JSON_W not found . User might have never used recipient history before.', file=sys.stderr)
-            sys.exit(1)
-            
+            return SKIPPED
+
         f = open('%s.json' % user.name, 'w')
         f.write(json.dumps(webapp, sort_keys=True,
                            indent=4, separators=(',', ': ')))
         f.close()
-        sys.exit(0)
+        return 0
 
     if options.restore:
         if options.restorefile:
             filename = options.restorefile
         else:
             filename = '%s.json' % user.name
-        with open(filename) as data_file:
-            data = json.load(data_file)
+        with open(filename, 'rb') as data_file:
+            data = json_loads(data_file.read())
         user.store.mapiobj.SetProps([SPropValue(0X6773001F, u'%s' % json.dumps(data))])
         user.store.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
-        sys.exit(0)
+        return 0
 
     if options.list:
         print(json.dumps(webapp, sort_keys=True,
                          indent=4, separators=(',', ': ')))
-        sys.exit(0)
+        return 0
 
-    if options.remove:
+    if options.remove or options.removefile:
+        if matcher is None:
+            matcher = build_matcher(options)
         newlist = json.loads('{"recipients":[]}')
         for rec in webapp['recipients']:
-            if options.remove in rec['display_name'] or options.remove in rec['smtp_address'] \
-                    or options.remove in rec['email_address']:
+            if matcher.match(rec):
                 print('removing contact %s [%s]' % (rec['display_name'], rec['smtp_address']))
             else:
                 newlist['recipients'].append(rec)
 
-        if not options.dryrun:
+        # Nothing to write when no recipient matched
+        if not options.dryrun and len(newlist['recipients']) != len(webapp['recipients']):
             user.store.mapiobj.SetProps([SPropValue(0X6773001F, u'%s' % json.dumps(newlist))])
             user.store.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
 
-        sys.exit(0)
+        return len(webapp['recipients']) - len(newlist['recipients'])
 
     if options.removeall:
         newlist = json.loads('{"recipients":[]}')
@@ -85,7 +302,306 @@ def main():
             user.store.mapiobj.SetProps([SPropValue(0X6773001F, u'%s' % json.dumps(newlist))])
             user.store.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
 
+        return len(webapp['recipients'])
+
+    if options.compact:
+        newlist = dict(webapp)
+        newlist['recipients'] = compact_recipients(webapp['recipients'], options.max_recipients, options.max_age)
+        removed = len(webapp['recipients']) - len(newlist['recipients'])
+        if removed:
+            data = u'%s' % json.dumps(newlist)
+            print('compacted %d to %d recipients, %d bytes saved' % (len(webapp['recipients']), len(newlist['recipients']),
+                                                                     size - len(data.encode('utf-8'))))
+            if not options.dryrun:
+                user.store.mapiobj.SetProps([SPropValue(0X6773001F, data)])
+                user.store.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        return removed
+
+    return 0
+
+
+def selected_users(server, options):
+    if options.all_users:
+        return server.users()
+    if options.users:
+        # Look up all users first, so a typo does not leave a half finished run
+        return [server.user(name) for name in options.users.split(',')]
+    return [server.user(options.user)]
+
+
+def manage_user(user, options, matcher):
+    """Run for one user in a worker thread, returns the output and the result of manage()"""
+    buffer = io.StringIO()
+    sys.stdout.local.buffer = buffer
+    sys.stderr.local.buffer = buffer
+    try:
+        removed = manage(user, options, matcher)
+    except Exception as e:
+        print('Error: {}'.format(e))
+        removed = None
+    finally:
+        sys.stdout.local.buffer = None
+        sys.stderr.local.buffer = None
+    return buffer.getvalue(), removed
+
+
+def export_histories(server, options):
+    """Write the histories of the selected users as JSON lines, one user at a time"""
+    try:
+        users = selected_users(server, options)
+    except NotFoundError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    stream = sys.stdout if options.exportfile == '-' else open(options.exportfile, 'w')
+    exported = 0
+    try:
+        for user in users:
+            try:
+                webapp = json_loads(user.store.prop(0X6773001F).value)
+            except NotFoundError:
+                continue
+            stream.write(json.dumps({'user': user.name, 'history': webapp}) + '\n')
+            exported += 1
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    print('Exported the recipient history of %d users' % exported, file=sys.stderr)
+    return 0
+
+
+def import_histories(server, options):
+    """Write the histories of a JSON lines export, with --jobs writers in parallel"""
+    names = None
+    if options.user or options.users:
+        names = set(options.users.split(',') if options.users else [options.user])
+
+    stream = sys.stdin if options.importfile == '-' else open(options.importfile)
+    jobs = options.jobs or 1
+    # Only a few histories are read ahead of the writers
+    slots = threading.Semaphore(jobs * 2)
+    lock = threading.Lock()
+    imported = []
+    failed = []
+
+    def write(name, data):
+        try:
+            user = server.user(name)
+            if not options.dryrun:
+                user.store.mapiobj.SetProps([SPropValue(0X6773001F, data)])
+                user.store.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        except Exception as e:
+            print('%s: Error importing the recipient history: %s' % (name, e))
+            with lock:
+                failed.append(name)
+        else:
+            with lock:
+                imported.append(name)
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for number, line in enumerate(stream, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json_loads(line)
+                    name = record['user']
+                    data = u'%s' % json.dumps(record['history'])
+                except (ValueError, KeyError, TypeError) as e:
+                    print('Line %d is not a valid recipient history: %s' % (number, e))
+                    with lock:
+                        failed.append('line %d' % number)
+                    continue
+                if names is not None and name not in names:
+                    continue
+                slots.acquire()
+                executor.submit(write, name, data)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+    print('%s the recipient history of %d users' % ('Would import' if options.dryrun else 'Imported', len(imported)))
+    if failed:
+        print('Failed for %d users: %s' % (len(failed), ', '.join(failed)))
+    return len(failed)
+
+
+def run(server, options):
+    """Run for the selected users, returns the number of users that failed"""
+    if options.exportfile:
+        return export_histories(server, options)
+    if options.importfile:
+        return import_histories(server, options)
+
+    # The patterns are compiled once for all users
+    matcher = None
+    if options.remove or options.removefile:
+        try:
+            matcher = build_matcher(options)
+        except (IOError, ValueError, re.error) as e:
+            print(e)
+            return 1
+
+    bulk = bool(options.all_users or options.users)
+    if not bulk:
+        # A single user without recipient history still fails, like before
+        return 0 if manage(server.user(options.user), options, matcher) not in (None, SKIPPED) else 1
+
+    try:
+        users = selected_users(server, options)
+    except NotFoundError as e:
+        print(e)
+        return 1
+
+    results = []
+    if options.jobs and options.jobs > 1:
+        # Workers write to their own buffer, the output is printed per user in order
+        stdout, stderr = sys.stdout, sys.stderr
+        if not isinstance(stdout, ThreadOutput):
+            sys.stdout, sys.stderr = ThreadOutput(stdout), ThreadOutput(stderr)
+        try:
+            with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+                users = list(users)
+                for user, (output, removed) in zip(users, executor.map(lambda user: manage_user(user, options, matcher), users)):
+                    if output:
+                        print('[%s]\n%s' % (user.name, output), end='')
+                    results.append((user.name, removed))
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+    else:
+        for user in users:
+            print('[%s]' % user.name)
+            try:
+                removed = manage(user, options, matcher)
+            except Exception as e:
+                print('Error: {}'.format(e))
+                removed = None
+            results.append((user.name, removed))
+
+    failed = [name for name, removed in results if removed is None]
+    skipped = [name for name, removed in results if removed == SKIPPED]
+    if options.remove or options.removefile or options.removeall or options.compact:
+        removed = [(name, count) for name, count in results if count]
+        print('%s %d recipients for %d of %d users' % ('Would remove' if options.dryrun else 'Removed',
+              sum(count for name, count in removed), len(removed), len(results)))
+        for name, count in removed:
+            print('  %s: %d' % (name, count))
+    if skipped:
+        print('Skipped %d users without recipient history: %s' % (len(skipped), ', '.join(skipped)))
+    if failed:
+        print('Failed for %d users: %s' % (len(failed), ', '.join(failed)))
+    return len(failed)
+
+
+class ThreadOutput(object):
+    """Stream that writes to the buffer of the current thread when it has one"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(data)
+        return buffer.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Handle a request of the form {"args": ["--user", "john", "--list"]},
+    the reply is {"status": 0, "output": "..."}"""
+
+    def handle(self):
+        buffer = io.StringIO()
+        with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(buffer):
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                status = self.server.run_request([str(arg) for arg in request.get('args', [])])
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code)
+                    status = 1
+            except Exception as e:
+                print('Error: {!r}'.format(e))
+                status = 1
+        self.wfile.write((json.dumps({'status': status, 'output': buffer.getvalue()}) + '\n').encode('utf-8'))
+
+
+def daemon(options):
+    """Handle requests on a Unix socket one at a time until interrupted, the server
+    connection is kept open between requests"""
+    # Log on at startup, so configuration problems show up right away
+    connection = {'server': kopano.Server(options)}
+
+    def run_request(args):
+        request, args = opt_args(args)
+        if request.daemon:
+            print('--daemon can not be used in a daemon request')
+            return 1
+        if not (request.user or request.users or request.all_users or request.importfile):
+            print('Please use:\n --user <username>')
+            return 1
+        if connection['server'] is None:
+            connection['server'] = kopano.Server(options)
+        try:
+            failed = run(connection['server'], request)
+        except CONNECTION_ERRORS:
+            # A broken connection is not reused, other errors (e.g. an unknown user) leave it usable
+            connection['server'] = None
+            raise
+        return 1 if failed else 0
+
+    # Only a socket left behind by an earlier daemon is removed
+    if os.path.lexists(options.daemon):
+        if not stat.S_ISSOCK(os.lstat(options.daemon).st_mode):
+            print('%s exists and is not a socket' % options.daemon)
+            sys.exit(1)
+        os.unlink(options.daemon)
+    # Only the owner may connect, the daemon runs with the credentials of the admin.
+    # The socket is created without permissions for others.
+    umask = os.umask(0o077)
+    try:
+        socket_server = socketserver.UnixStreamServer(options.daemon, DaemonHandler)
+    finally:
+        os.umask(umask)
+    socket_server.run_request = run_request
+
+    print('Waiting for requests on {}'.format(options.daemon))
+    try:
+        socket_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket_server.server_close()
+        os.unlink(options.daemon)
+
+
+def main():
+    options, args = opt_args()
+
+    if options.daemon:
+        daemon(options)
+        sys.exit(0)
+
+    if not (options.user or options.users or options.all_users or options.importfile):
+        print('Please use:\n %s --user <username>\n or --users <user1,user2> or --all-users instead of --user' % (sys.argv[0]))
         sys.exit(0)
 
+    if options.restorefile and (options.users or options.all_users):
+        print('--restore-file can only be used with --user')
+        sys.exit(1)
+
+    if run(kopano.Server(options), options):
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -13,13 +13,31 @@ try:
         PR_MESSAGE_CLASS_W, PR_SENDER_NAME_W, PR_SUBJECT, PR_MESSAGE_CLASS, 
         PR_MESSAGE_DELIVERY_TIME,PR_CLIENT_SUBMIT_TIME, PR_SENDER_NAME, 
         PR_SENDER_EMAIL_ADDRESS, PR_SUBJECT_PREFIX, PR_RECEIVED_BY_NAME, PR_INTERNET_MESSAGE_ID, 
-        PR_BODY, PR_MESSAGE_DELIVERY_TIME
+        PR_BODY, PR_MESSAGE_DELIVERY_TIME, PR_ENTRYID, PR_SUBJECT_W, PR_RECEIVED_BY_NAME_W,
+        PR_INTERNET_MESSAGE_ID_W, PR_ACCOUNT_W, PR_DISPLAY_NAME_W, PR_SMTP_ADDRESS_W, PR_TITLE_W,
+        PR_BUSINESS_TELEPHONE_NUMBER_W, PR_MOBILE_TELEPHONE_NUMBER_W, PR_DEPARTMENT_NAME_W, PR_COMPANY_NAME_W,
+        PR_OFFICE_LOCATION_W, PR_STREET_ADDRESS_W, PR_LOCALITY_W, PR_POSTAL_CODE_W, PR_COUNTRY_W
         )
+    from MAPI.Util import *
+    import MAPI.Time
 except ImportError:
     print('python-mapi should be installed on your system')
     sys.exit(1)
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import base64
+import csv
+import hashlib
+import bisect
+import gzip
+import html
+import os
+import re
+import string
+import zlib
 try:
     import OpenSSL.crypto
 except ImportError:
@@ -32,14 +50,22 @@ import time
 from functools import reduce
 from operator import getitem
 from optparse import OptionGroup
+import io
+import socketserver
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
+from contextlib import contextmanager
 
 """
 Read user settings
 
 :param print_help: Print help
+:param args: Arguments to parse, sys.argv when empty
 :return: Parser arguments
 """
-def opt_args(print_help=None):
+def opt_args(print_help=None, args=None):
 
     # Define the kopano parser
     parser = kopano.parser('skpcufmUP')
@@ -52,6 +78,17 @@ def opt_args(print_help=None):
     group.add_option("--backup", dest="backup", action="store_true", help="Backup Webapp settings")
     group.add_option("--restore", dest="restore", action="store_true", help="Restore Webapp settings")
     group.add_option("--reset", dest="reset", action="store_true", help="Reset WebApp settings")
+    group.add_option("--archive", dest="archive", action="store", metavar="FILE", help="Backup/restore the settings of all users to/from a single archive")
+    group.add_option("--incremental", dest="incremental", action="store_true", help="Only backup users whose settings changed since the last backup in --location, with --backup-signature store every distinct signature once")
+    group.add_option("--restore-point", dest="restore_point", action="store", metavar="YYYYMMDD", help="Restore the settings as of the given night from an incremental backup")
+    group.add_option("--jobs", dest="jobs", action="store", type="int", metavar="N", help="Process N users in parallel, each worker uses its own server connection")
+    group.add_option("--latency-target", dest="latency_target", action="store", type="float", metavar="MS", help="Adapt the number of concurrent server calls to keep their latency below MS milliseconds")
+    group.add_option("--max-ops-per-second", dest="max_ops", action="store", type="float", metavar="N", help="Never do more than N server calls per second")
+    group.add_option("--journal", dest="journal", action="store", metavar="FILE", help="Record every processed user in a journal file")
+    group.add_option("--resume", dest="resume", action="store_true", help="Skip users that completed the same operation according to the journal")
+    group.add_option("--stats", dest="stats", action="store", metavar="FILE", help="Write timings, call counts and bytes moved per phase and per user as JSON")
+    group.add_option("--daemon", dest="daemon", action="store", metavar="SOCKET", help="Keep server connections open and handle requests on a Unix socket")
+    group.add_option("--prometheus", dest="prometheus", action="store", metavar="FILE", help="Write timings, call counts and bytes moved per phase for the Prometheus textfile collector")
     parser.add_option_group(group)
 
     # Addionals stores group
@@ -69,18 +106,26 @@ def opt_args(print_help=None):
     group.add_option("--restore-signature", dest="restore_signature", action="store", help="Restore signature (need file name)")
     group.add_option("--replace-signature", dest="replace_signature", action="store", help="Replace existing signature, file layout must be: username_signature-name_signatureid.html or signature-name_signatureid.html ")
     group.add_option("--default-signature", dest="default_signature", action="store_true", help="Set signature as default one")
+    group.add_option("--signature-template", dest="signature_template", action="store", metavar="FILE", help="Add the signature in the html template FILE, filled in with the address book details of every user ($fullname, ${phone}, use $$ for a literal $)")
+    group.add_option("--signature-name", dest="signature_name", action="store", help="Name of the signature of --signature-template, default the file name")
     parser.add_option_group(group)
 
     # Categories setting option group
     group = OptionGroup(parser, "Categories", "")
     group.add_option("--export-categories", dest="export_categories", action="store_true", help="Export Categories (name and color)")
     group.add_option("--import-categories", dest="import_categories", action="store_true", help="Import Categories (name and color)")
+    group.add_option("--merge-categories", dest="merge_categories", action="store", metavar="FILE", help="Add the categories of FILE that the user does not have yet, keeping the other categories of the user")
+    group.add_option("--update-colors", dest="update_colors", action="store_true", help="With --merge-categories, also change the color of existing categories to the color in FILE")
     parser.add_option_group(group)
 
     # S/MIME option group
     group = OptionGroup(parser, "S/MIME", "")
     group.add_option("--export-smime", dest="export_smime", action="store_true", help="Export private S/MIME certificate")
     group.add_option("--import-smime", dest="import_smime", action="store", help="Import private S/MIME certificate")
+    group.add_option("--import-smime-dir", dest="import_smime_dir", action="store", metavar="DIR", help="Import the private S/MIME certificates (.p12/.pfx) in DIR for the users they belong to")
+    group.add_option("--smime-inventory", dest="smime_inventory", action="store", metavar="FILE", help="Write the S/MIME certificates of the users to FILE, CSV when it ends with .csv and JSON lines otherwise, - for stdout")
+    group.add_option("--expires-within", dest="expires_within", action="store", type="int", metavar="DAYS", help="Only list the certificates that expire in the next DAYS days")
+    group.add_option("--expired", dest="expired", action="store_true", help="Only list the certificates that have expired")
     group.add_option("--remove-expired", dest="remove_expired", action="store_true", help="Remove expired public S/MIME certificates")
     group.add_option("--public", dest="public_smime", action="store_true", help="Export/Import public S/MIME certificate")
     group.add_option("--password", dest="password", action="store", help="set password")
@@ -126,7 +171,375 @@ def opt_args(print_help=None):
         parser.print_help()
         sys.exit()
 
-    return parser.parse_args()
+    return parser.parse_args(args)
+
+
+"""
+Adaptive limit for the calls to the server. The number of calls in flight is
+increased by one per round of calls that stay below the latency target and
+halved when a call is slower or fails (AIMD). Optionally the calls are spaced
+to stay below a maximum number of calls per second.
+"""
+class Throttle(object):
+    def __init__(self, limit, latency_target=None, max_ops=None):
+        self.max_limit = max(1, limit)
+        self.limit = float(self.max_limit)
+        self.latency_target = latency_target / 1000.0 if latency_target else None
+        self.interval = 1.0 / max_ops if max_ops else 0
+        self.next_slot = 0
+        self.decreased = 0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        delay = 0
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            if self.interval:
+                now = time.monotonic()
+                slot = max(now, self.next_slot)
+                self.next_slot = slot + self.interval
+                delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+        return time.monotonic()
+
+    def release(self, start, error=False):
+        latency = time.monotonic() - start
+        with self.condition:
+            self.in_flight -= 1
+            if self.latency_target:
+                if error or latency > self.latency_target:
+                    # Only back off once for calls that were started before the last decrease
+                    if start > self.decreased:
+                        self.limit = max(1.0, self.limit / 2)
+                        self.decreased = time.monotonic()
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+# Throttle for the server calls, None when not throttling
+throttle = None
+
+
+"""
+Metrics of the hot paths. For every phase (server calls, JSON handling) the
+number of calls, the time spent, the bytes moved and a latency histogram are
+recorded, in total and per user.
+"""
+class Metrics(object):
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = {}
+        self.users = {}
+
+    def record(self, phase, seconds, nbytes=0):
+        user = getattr(self.local, 'user', None)
+        with self.lock:
+            total = self.phases.get(phase)
+            if total is None:
+                total = self.phases[phase] = {'count': 0, 'seconds': 0.0, 'bytes': 0, 'buckets': [0] * (len(self.BUCKETS) + 1)}
+            total['count'] += 1
+            total['seconds'] += seconds
+            total['bytes'] += nbytes
+            total['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            if user:
+                per_user = self.users.setdefault(user, {}).setdefault(phase, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                per_user['count'] += 1
+                per_user['seconds'] += seconds
+                per_user['bytes'] += nbytes
+
+    def write_json(self, filename):
+        phases = {}
+        for phase, total in self.phases.items():
+            phases[phase] = dict(total, buckets=dict(zip([str(le) for le in self.BUCKETS] + ['+Inf'], total['buckets'])))
+        summary = {
+            'operation': self.operation,
+            'start': int(self.start),
+            'duration': time.time() - self.start,
+            'phases': phases,
+            'users': self.users,
+            'settings_writes': dict(write_counts),
+        }
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+    def write_prometheus(self, filename):
+        operation = self.operation.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines = [
+            '# HELP kopano_webapp_admin_phase_duration_seconds Duration of the calls per phase',
+            '# TYPE kopano_webapp_admin_phase_duration_seconds histogram',
+        ]
+        for phase, total in sorted(self.phases.items()):
+            labels = 'operation="{}",phase="{}"'.format(operation, phase)
+            count = 0
+            for le, bucket in zip([str(le) for le in self.BUCKETS] + ['+Inf'], total['buckets']):
+                count += bucket
+                lines.append('kopano_webapp_admin_phase_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, count))
+            lines.append('kopano_webapp_admin_phase_duration_seconds_sum{%s} %f' % (labels, total['seconds']))
+            lines.append('kopano_webapp_admin_phase_duration_seconds_count{%s} %d' % (labels, total['count']))
+        lines += [
+            '# HELP kopano_webapp_admin_phase_bytes_total Bytes read or written per phase',
+            '# TYPE kopano_webapp_admin_phase_bytes_total counter',
+        ]
+        for phase, total in sorted(self.phases.items()):
+            lines.append('kopano_webapp_admin_phase_bytes_total{operation="%s",phase="%s"} %d' % (operation, phase, total['bytes']))
+        lines += [
+            '# HELP kopano_webapp_admin_settings_writes_total Number of users whose settings were written, unchanged or failed to write',
+            '# TYPE kopano_webapp_admin_settings_writes_total counter',
+        ]
+        for result, count in sorted(write_counts.items()):
+            lines.append('kopano_webapp_admin_settings_writes_total{operation="%s",result="%s"} %d' % (operation, result, count))
+        lines += [
+            '# HELP kopano_webapp_admin_users Number of processed users',
+            '# TYPE kopano_webapp_admin_users gauge',
+            'kopano_webapp_admin_users{operation="%s"} %d' % (operation, len(self.users)),
+            '# HELP kopano_webapp_admin_run_duration_seconds Duration of the run',
+            '# TYPE kopano_webapp_admin_run_duration_seconds gauge',
+            'kopano_webapp_admin_run_duration_seconds{operation="%s"} %f' % (operation, time.time() - self.start),
+            '# HELP kopano_webapp_admin_last_run_timestamp_seconds Start time of the run',
+            '# TYPE kopano_webapp_admin_last_run_timestamp_seconds gauge',
+            'kopano_webapp_admin_last_run_timestamp_seconds{operation="%s"} %d' % (operation, self.start),
+        ]
+        # Write atomically, the collector could read the file at any time
+        with open(filename + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(filename + '.tmp', filename)
+
+
+# Metrics of the current run, None when not measuring
+metrics = None
+
+
+"""
+Measurement of a single call, the bytes are filled in by the caller
+"""
+class Call(object):
+    __slots__ = ('bytes',)
+
+    def __init__(self):
+        self.bytes = 0
+
+
+# Shared by all calls that are not measured
+unmeasured_call = Call()
+
+
+"""
+Context manager around a call to the server which is passed through the
+throttle when throttling is enabled and measured when metrics are enabled
+
+:param phase: Name of the phase the call belongs to
+"""
+@contextmanager
+def server_call(phase='server'):
+    if throttle is None and metrics is None:
+        yield unmeasured_call
+        return
+    call = Call()
+    start = throttle.acquire() if throttle else time.monotonic()
+    error = False
+    try:
+        yield call
+    except kopano.NotFoundError:
+        raise
+    except Exception:
+        error = True
+        raise
+    finally:
+        if throttle:
+            throttle.release(start, error)
+        if metrics:
+            metrics.record(phase, time.monotonic() - start, call.bytes)
+
+
+"""
+Context manager measuring local work (e.g. JSON handling) when metrics are
+enabled
+
+:param phase: Name of the phase
+"""
+@contextmanager
+def timed(phase):
+    if metrics is None:
+        yield unmeasured_call
+        return
+    call = Call()
+    start = time.monotonic()
+    try:
+        yield call
+    finally:
+        metrics.record(phase, time.monotonic() - start, call.bytes)
+
+
+# Options that do not change what is done for a user
+RUNTIME_OPTIONS = {'all_users', 'jobs', 'latency_target', 'max_ops', 'journal', 'resume', 'stats', 'prometheus', 'daemon', 'password', 'ask_password'}
+
+
+"""
+Describe the requested operation, used to match journal entries of earlier runs
+
+:param options: Parser arguments
+:return: The operation as a string
+"""
+def operation_name(options):
+    ignore = RUNTIME_OPTIONS | set(option.dest for option in kopano.parser('skpcufmUP').option_list)
+    operation = []
+    for key, value in sorted(vars(options).items()):
+        if key in ignore or value is None or value is False:
+            continue
+        operation.append(key if value is True else '{}={}'.format(key, value))
+    return ','.join(operation)
+
+
+"""
+Journal of processed users. Every user is recorded as a JSON line with the
+operation, the status and the hash of the resulting WebApp settings.
+"""
+class Journal(object):
+    def __init__(self, filename, operation):
+        self.filename = filename
+        self.operation = operation
+        self.lock = threading.Lock()
+
+    def completed(self):
+        done = set()
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partially written line of a run that was killed
+                        continue
+                    if entry.get('operation') != self.operation:
+                        continue
+                    if entry.get('status') == 'ok':
+                        done.add(entry['user'])
+                    else:
+                        done.discard(entry['user'])
+        except IOError:
+            pass
+        return done
+
+    def record(self, username, status, settings=None):
+        content_hash = None
+        if settings is not None:
+            content_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+        entry = {'user': username, 'operation': self.operation, 'status': status, 'hash': content_hash, 'time': int(time.time())}
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+# Journal of the current run, None when not journaling
+journal = None
+
+
+"""
+Parse JSON. orjson is used when installed as it is a lot faster on big
+settings and gives the same result as json.loads. Serializing is always done
+with json.dumps, so the written settings stay exactly the same.
+
+:param data: JSON document (str or bytes)
+:return: The parsed document
+"""
+def json_loads(data):
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # Documents orjson does not accept (e.g. NaN or integers > 64 bit)
+            pass
+    return json.loads(data)
+
+
+# Open settings sessions, keyed on the thread and the username
+sessions = {}
+
+# Number of users whose settings were written or left alone because nothing changed
+write_counts = {'written': 0, 'unchanged': 0, 'failed': 0}
+write_counts_lock = threading.Lock()
+
+EMPTY_SETTINGS = '{"settings": {"zarafa": {"v1": {"contexts": {"mail": {}}}}}}'
+
+
+"""
+Key of the settings session of the user. Every thread has its own sessions,
+so concurrent runs for the same user do not share a session.
+
+:param user: The user
+:return: The session key
+"""
+def session_key(user):
+    return (threading.get_ident(), user.name)
+
+
+"""
+Open a settings session for the user. Until commit_settings is called every
+operation reads and changes the same in-memory settings tree.
+
+:param user: The user
+"""
+def open_settings(user):
+    sessions[session_key(user)] = {'settings': None, 'raw': None, 'dirty': False}
+
+
+"""
+Close the settings session and write the settings into the user store if
+they were changed
+
+:param user: The user
+:return: Tuple of the settings of the session (None if they were never read)
+and False if writing the settings failed
+"""
+def commit_settings(user):
+    session = sessions.pop(session_key(user), None)
+    if not session:
+        return None, True
+    stored = True
+    if session['dirty']:
+        with timed('json_dump') as call:
+            setting = json.dumps(session['settings'])
+            call.bytes = len(setting)
+        if settings_unchanged(session['raw'], setting, session['settings']):
+            counter = 'unchanged'
+        else:
+            stored = store_settings(user, setting)
+            counter = 'written' if stored else 'failed'
+        with write_counts_lock:
+            write_counts[counter] += 1
+    return session['settings'], stored
+
+
+"""
+Check if the new settings are the same as the settings that were read. The
+settings are compared as canonical JSON, as the stored settings could be
+written by WebApp with a different layout.
+
+:param raw: The settings as read from the store
+:param setting: The serialized new settings
+:param settings: The new settings
+:return: True when the settings did not change
+"""
+def settings_unchanged(raw, setting, settings):
+    if raw is None:
+        return False
+    if raw == setting:
+        return True
+    try:
+        original = json_loads(raw)
+    except ValueError:
+        return False
+    return json.dumps(original, sort_keys=True) == json.dumps(settings, sort_keys=True)
 
 
 """
@@ -136,26 +549,176 @@ Read user settings
 :return: Settings
 """
 def read_settings(user):
+    session = sessions.get(session_key(user))
+    if session and session['settings'] is not None:
+        return session['settings']
+
+    mapisettings = read_raw_settings(user)
     try:
-        mapisettings = user.store.prop(PR_EC_WEBACCESS_SETTINGS_JSON).value.decode('utf-8')
-        settings = json.loads(mapisettings)
+        with timed('json_parse') as call:
+            call.bytes = len(mapisettings) if mapisettings else 0
+            settings = json_loads(mapisettings)
     except Exception as e:
         print('{}: Has no or no valid WebApp settings creating empty config tree'.format(user.name))
-        settings = json.loads('{"settings": {"zarafa": {"v1": {"contexts": {"mail": {}}}}}}')
+        settings = json.loads(EMPTY_SETTINGS)
+        mapisettings = None
+
+    if session:
+        session['settings'] = settings
+        session['raw'] = mapisettings
     return settings
 
 
 """
-Write WebApp setting into the user store
+Read the serialized user settings, once per settings session
+
+:param user: The user
+:return: Settings as string or None if the user has no settings
+"""
+def read_raw_settings(user):
+    session = sessions.get(session_key(user))
+    if session and session['raw'] is not None:
+        return session['raw']
+
+    try:
+        with server_call('read') as call:
+            mapisettings = user.store.prop(PR_EC_WEBACCESS_SETTINGS_JSON).value
+            call.bytes = len(mapisettings)
+        mapisettings = mapisettings.decode('utf-8')
+    except Exception as e:
+        return None
+
+    if session:
+        session['raw'] = mapisettings
+    return mapisettings
+
+
+"""
+Read a single value of the user settings. When the settings are not parsed
+yet, only the requested value is parsed.
+
+:param user: The user
+:param path: Dotted path of the value (e.g. settings.zarafa.v1.contexts.mail.sendas)
+:param default: Value returned when the path does not exist
+:return: The value
+"""
+def read_settings_path(user, path, default=None):
+    keys = path.split('.')
+    session = sessions.get(session_key(user))
+    if session and session['settings'] is not None:
+        try:
+            return reduce(getitem, keys, session['settings'])
+        except (KeyError, TypeError):
+            return default
+
+    mapisettings = read_raw_settings(user)
+    if mapisettings is None:
+        return default
+    try:
+        return extract_path(mapisettings, keys, default)
+    except ValueError:
+        return default
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_SCALAR = re.compile(r'[^,}\]\s]*')
+json_decoder = json.JSONDecoder()
+# Decoder used to skip objects and arrays, the objects are never built
+json_skip_decoder = json.JSONDecoder(object_pairs_hook=len)
+
+
+"""
+Find the end of the JSON value that starts at index
+
+:param document: JSON document
+:param index: Start of the value
+:return: Index directly after the value
+"""
+def skip_json_value(document, index):
+    char = document[index:index + 1]
+    if char == '"':
+        end = index
+        while True:
+            end = document.find('"', end + 1)
+            if end == -1:
+                raise ValueError('Unterminated string at {}'.format(index))
+            # The quote is escaped when preceded by an odd number of backslashes
+            start = end - 1
+            while document[start] == '\\':
+                start -= 1
+            if (end - start) % 2:
+                return end + 1
+    if char in ('{', '['):
+        return json_skip_decoder.raw_decode(document, index)[1]
+    return JSON_SCALAR.match(document, index).end()
+
+
+"""
+Extract the value at a path from a JSON document without parsing the rest of
+the document. Only the values along the path and the requested value are
+parsed, everything else is skipped.
+
+:param document: JSON document
+:param keys: The keys of the path
+:param default: Value returned when the path does not exist
+:return: The value
+"""
+def extract_path(document, keys, default=None):
+    index = JSON_WHITESPACE.match(document, 0).end()
+    for key in keys:
+        if document[index:index + 1] != '{':
+            return default
+        index = JSON_WHITESPACE.match(document, index + 1).end()
+        while True:
+            if document[index:index + 1] == '}':
+                return default
+            end = skip_json_value(document, index)
+            name = json.loads(document[index:end])
+            index = JSON_WHITESPACE.match(document, end).end()
+            if document[index:index + 1] != ':':
+                raise ValueError('Expected : at {}'.format(index))
+            index = JSON_WHITESPACE.match(document, index + 1).end()
+            if name == key:
+                break
+            index = JSON_WHITESPACE.match(document, skip_json_value(document, index)).end()
+            if document[index:index + 1] == ',':
+                index = JSON_WHITESPACE.match(document, index + 1).end()
+    return json_decoder.raw_decode(document, index)[0]
+
+
+"""
+Write WebApp setting. When a settings session is open the write is deferred
+until the session is committed.
+
+:param user: The user
+:param settings: The settings that should be written
+"""
+def write_settings(user, settings):
+    session = sessions.get(session_key(user))
+    if session:
+        session['settings'] = settings
+        session['dirty'] = True
+        return
+    store_settings(user, json.dumps(settings))
+
+
+"""
+Write serialized WebApp settings into the user store
 
 :param user: The user
 :param setting: The setting that should be written
+:return: False if writing the settings failed
 """
-def write_settings(user, setting):
+def store_settings(user, setting):
     try:
-        user.store.create_prop(PR_EC_WEBACCESS_SETTINGS_JSON, setting.encode('utf-8'))
+        with server_call('write') as call:
+            setting = setting.encode('utf-8')
+            call.bytes = len(setting)
+            user.store.create_prop(PR_EC_WEBACCESS_SETTINGS_JSON, setting)
     except Exception as e:
         print('{}: Error Writing WebApp settings for user: {}'.format(e, user.name))
+        return False
+    return True
 
 
 """
@@ -164,7 +727,7 @@ Reset all WebApp settings to default
 :param user: The user
 """
 def reset_settings(user):
-    user.store.create_prop(PR_EC_WEBACCESS_SETTINGS_JSON, '{"settings": {"zarafa": {"v1": {"contexts": {"mail": {}}}}}}'.encode('utf-8'))
+    write_settings(user, json.loads(EMPTY_SETTINGS))
     print('Removed WebApp settings for user: {}'.format(user.name))
 
 
@@ -188,6 +751,228 @@ def backup(user, location=None):
     print('Creating backup WebApp settings for user {}'.format(user.name))
 
 
+"""
+Backup archive holding the settings of many users. Every user is written as
+a JSON line in its own gzip member, so the archive can be read with zcat while
+the index (<archive>.index) allows restoring a single user without
+decompressing the rest of the archive.
+"""
+class Archive(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = '%s.index' % filename
+        self.file = None
+        self.index = None
+        self.lock = threading.Lock()
+
+    def add(self, username, data):
+        member = gzip.compress((json.dumps(data) + '\n').encode('utf-8'))
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.filename, 'wb')
+                self.index = {}
+            offset = self.file.tell()
+            self.file.write(member)
+            self.index[username] = [offset, len(member)]
+
+    def get(self, username):
+        with self.lock:
+            if self.index is None:
+                self.index = self.read_index()
+        if username not in self.index:
+            return None
+        offset, length = self.index[username]
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            member = f.read(length)
+        return json_loads(gzip.decompress(member))
+
+    def read_index(self):
+        try:
+            with open(self.index_filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            print('No index found for {}, scanning the archive'.format(self.filename))
+            return self.scan()
+
+    # Rebuild the index by walking the gzip members, e.g. after an interrupted backup
+    def scan(self):
+        index = {}
+        offset = 0
+        pending = b''
+        with open(self.filename, 'rb') as f:
+            while True:
+                decompressor = zlib.decompressobj(31)
+                start = offset
+                line = b''
+                while not decompressor.eof:
+                    chunk = pending or f.read(65536)
+                    if not chunk:
+                        return index
+                    line += decompressor.decompress(chunk)
+                    pending = decompressor.unused_data
+                    offset += len(chunk) - len(pending)
+                index[json_loads(line)['user']] = [start, offset - start]
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        with open(self.index_filename, 'w') as f:
+            json.dump(self.index, f)
+
+
+# Backup archive of the current run, None when not using an archive
+archive = None
+
+
+"""
+Get the WebApp settings and persistent settings (signatures and categories
+included) of the user
+
+:param user: The user
+:return: Backup data of the user
+"""
+def backup_data(user):
+    with server_call('read'):
+        persistent_settings = user.store.get_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W)
+    return {
+        'user': user.name,
+        'settings': read_settings(user),
+        'persistent_settings': json_loads(persistent_settings.value) if persistent_settings else None,
+    }
+
+
+"""
+Restore the WebApp settings and persistent settings of the user
+
+:param user: The user
+:param data: Backup data of the user
+"""
+def restore_data(user, data):
+    write_settings(user, data['settings'])
+    if data.get('persistent_settings') is not None:
+        with server_call('write'):
+            user.store.create_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W, json.dumps(data['persistent_settings']))
+
+
+"""
+Backup the WebApp settings, including signatures and categories, of the user
+into the archive
+
+:param user: The user
+"""
+def backup_archive(user):
+    archive.add(user.name, backup_data(user))
+    print('Adding WebApp settings for user {} to archive'.format(user.name))
+
+
+"""
+Restore the WebApp settings, including signatures and categories, of the
+user from the archive
+
+:param user: The user
+"""
+def restore_archive(user):
+    data = archive.get(user.name)
+    if not data:
+        print('No WebApp settings for user {} in archive'.format(user.name))
+        return
+    print('Restoring WebApp settings for user {} from archive'.format(user.name))
+    restore_data(user, data)
+
+
+"""
+Incremental backup. A user is only written to <location>/<YYYYMMDD>/<user>.json
+when the hash of the settings differs from the last backup. The manifest
+(<location>/manifest.json) keeps the nights and hashes of all backups of a
+user, so the settings as of any night can be found.
+"""
+class IncrementalBackup(object):
+    def __init__(self, location):
+        self.location = location or '.'
+        self.filename = os.path.join(self.location, 'manifest.json')
+        self.night = time.strftime('%Y%m%d')
+        self.lock = threading.Lock()
+        self.changed = False
+        try:
+            with open(self.filename) as f:
+                self.manifest = json.load(f)
+        except IOError:
+            self.manifest = {'users': {}}
+
+    def last(self, username, restore_point=None):
+        for night, content_hash in reversed(self.manifest['users'].get(username, [])):
+            if not restore_point or night <= restore_point:
+                return night, content_hash
+        return None, None
+
+    def add(self, username, data):
+        content_hash = hashlib.sha256(json.dumps([data['settings'], data['persistent_settings']], sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+        if self.last(username)[1] == content_hash:
+            return False
+        directory = os.path.join(self.location, self.night)
+        with self.lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        with open(os.path.join(directory, '%s.json' % username), 'w') as f:
+            f.write(json.dumps(data))
+        with self.lock:
+            history = self.manifest['users'].setdefault(username, [])
+            if history and history[-1][0] == self.night:
+                history.pop()
+            history.append([self.night, content_hash])
+            self.changed = True
+        return True
+
+    def get(self, username, restore_point=None):
+        night = self.last(username, restore_point)[0]
+        if not night:
+            return None
+        with open(os.path.join(self.location, night, '%s.json' % username), 'rb') as f:
+            return json_loads(f.read())
+
+    def save(self):
+        if not self.changed:
+            return
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+# Incremental backup of the current run, None when not used
+incremental = None
+
+
+"""
+Backup the WebApp settings of the user if they changed since the last
+incremental backup
+
+:param user: The user
+"""
+def backup_incremental(user):
+    if incremental.add(user.name, backup_data(user)):
+        print('Creating incremental backup WebApp settings for user {}'.format(user.name))
+    else:
+        print('WebApp settings for user {} unchanged since last backup'.format(user.name))
+
+
+"""
+Restore the WebApp settings of the user from the incremental backup
+
+:param user: The user
+:param restore_point: Night (YYYYMMDD) to restore, the latest backup when empty
+"""
+def restore_incremental(user, restore_point=None):
+    data = incremental.get(user.name, restore_point)
+    if not data:
+        print('No incremental backup for user {}'.format(user.name))
+        return
+    print('Restoring WebApp settings for user {} from incremental backup'.format(user.name))
+    restore_data(user, data)
+
+
 """
 Restore user setting
 
@@ -199,10 +984,10 @@ def restore(user, filename=None):
         restorename = filename
     else:
         restorename= '%s.json' % user.name
-    with open(restorename) as data_file:
-        data = json.load(data_file)
+    with open(restorename, 'rb') as data_file:
+        data = json_loads(data_file.read())
     print('Restoring WebApp settings for user {}'.format(user.name))
-    write_settings(user, json.dumps(data))
+    write_settings(user, data)
 
 
 """
@@ -225,7 +1010,7 @@ def language(user, language):
         settings['settings']['zarafa']['v1']['main'] = {}
     settings['settings']['zarafa']['v1']['main']['language'] = language
     print('Setting locale to: {}'.format(language))
-    write_settings(user, json.dumps(settings))
+    write_settings(user, settings)
 
 
 """
@@ -243,7 +1028,7 @@ def add_store(user, user_to_add, folder_type, subfolder=False):
 
     settings['settings']['zarafa']['v1']['contexts']['hierarchy']['shared_stores'][user_to_add]= {folder_type : {'folder_type': folder_type, 'show_subfolders': subfolder}}
     print("Saving settings")
-    write_settings(user, json.dumps(settings))
+    write_settings(user, settings)
 
 
 """
@@ -274,17 +1059,14 @@ def del_store(user, user_to_del, folder_type=None):
     except KeyError:
         pass
     print("Saving settings")
-    write_settings(user, json.dumps(settings))
+    write_settings(user, settings)
 
 """
 List all added stores
 """
 def list_stores(user):
-    settings = read_settings(user) 
-
-    try:
-        stores =  settings['settings']['zarafa']['v1']['contexts']['hierarchy']['shared_stores']
-    except KeyError:
+    stores = read_settings_path(user, 'settings.zarafa.v1.contexts.hierarchy.shared_stores')
+    if stores is None:
         print("No additional stores found")
         return
     table_header = ["User", 'Folder type', 'Show subfolders']
@@ -325,6 +1107,86 @@ def backup_signature(user, location=None):
         print('user {} has no signature'.format(user.name))
 
 
+"""
+Content addressed signature backup. Every distinct signature is stored once
+as <location>/signatures/<sha256>.html, the manifest
+(<location>/signatures/manifest.json) maps the signatures of every user
+(id, name) to the hash of their content. A signature is only written when
+no earlier backup has the same content.
+"""
+class SignatureStore(object):
+    def __init__(self, location):
+        self.directory = os.path.join(location or '.', 'signatures')
+        self.filename = os.path.join(self.directory, 'manifest.json')
+        self.lock = threading.Lock()
+        self.changed = False
+        self.counts = {'written': 0, 'shared': 0, 'unchanged': 0}
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        try:
+            with open(self.filename) as f:
+                self.manifest = json.load(f)
+        except IOError:
+            self.manifest = {'users': {}}
+        # Hashes of the stored signatures, so a signature shared by many users is written once
+        self.blobs = set(name[:-5] for name in os.listdir(self.directory) if name.endswith('.html'))
+
+    def add(self, username, signatures):
+        previous = self.manifest['users'].get(username, {})
+        entries = {}
+        for signatureid, signature in signatures.items():
+            content = signature['content']
+            content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            entries[signatureid] = {'name': signature['name'], 'hash': content_hash}
+            if previous.get(signatureid, {}).get('hash') == content_hash and content_hash in self.blobs:
+                self.count('unchanged')
+                continue
+            with self.lock:
+                stored = content_hash in self.blobs
+                self.blobs.add(content_hash)
+            if stored:
+                self.count('shared')
+                continue
+            filename = os.path.join(self.directory, '%s.html' % content_hash)
+            with open(filename + '.tmp', 'w') as outfile:
+                outfile.write(content)
+            os.rename(filename + '.tmp', filename)
+            print('Dumping: \'{}\' of user {} to \'{}\' '.format(signature['name'], username, filename))
+            self.count('written')
+        if entries != previous:
+            with self.lock:
+                self.manifest['users'][username] = entries
+                self.changed = True
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def save(self):
+        if self.changed:
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.manifest, f)
+            os.rename(self.filename + '.tmp', self.filename)
+        print('Signatures written: {}, already stored for another user: {}, unchanged: {}'.format(
+            self.counts['written'], self.counts['shared'], self.counts['unchanged']))
+
+
+# Content addressed signature backup of the current run, None when not used
+signature_store = None
+
+
+"""
+Backup the signatures of the user into the content addressed signature backup
+
+:param user: The user
+"""
+def backup_signature_store(user):
+    signatures = read_settings_path(user, 'settings.zarafa.v1.contexts.mail.signatures.all', {})
+    if not signatures:
+        print('user {} has no signature'.format(user.name))
+    signature_store.add(user.name, signatures or {})
+
+
 """
 Restore signature into the users store
 
@@ -361,6 +1223,20 @@ def restore_signature(user, filename, replace=None, default=None):
         signatureid = int(time.time())
         action = 'Adding'
 
+    store_signature(user, signatureid, signaturename, signaturehtml, action, default)
+
+
+"""
+Store a signature in the WebApp settings of the user
+
+:param user: The user
+:param signatureid: The id of the signature
+:param signaturename: The name of the signature
+:param signaturehtml: The html of the signature
+:param action: Adding or Replacing, for the message
+:param default: Set the signature as default for new mail and replies
+"""
+def store_signature(user, signatureid, signaturename, signaturehtml, action, default=None):
     signaturecontent = dict(
         {u'name': signaturename, u'content': signaturehtml, u'isHTML': True})
     settings = read_settings(user)
@@ -385,7 +1261,135 @@ def restore_signature(user, filename, replace=None, default=None):
         settings['settings']['zarafa']['v1']['contexts']['mail']['signatures']['new_message'] = signatureid
         settings['settings']['zarafa']['v1']['contexts']['mail']['signatures']['replyforward_message'] = signatureid
 
-    write_settings(user, json.dumps(settings))
+    write_settings(user, settings)
+
+
+# Address book columns that can be used in a signature template, e.g. $fullname or ${phone}
+SIGNATURE_FIELDS = [
+    (PR_ACCOUNT_W, 'username'),
+    (PR_DISPLAY_NAME_W, 'fullname'),
+    (PR_SMTP_ADDRESS_W, 'email'),
+    (PR_TITLE_W, 'title'),
+    (PR_BUSINESS_TELEPHONE_NUMBER_W, 'phone'),
+    (PR_MOBILE_TELEPHONE_NUMBER_W, 'mobile'),
+    (PR_DEPARTMENT_NAME_W, 'department'),
+    (PR_COMPANY_NAME_W, 'company'),
+    (PR_OFFICE_LOCATION_W, 'office'),
+    (PR_STREET_ADDRESS_W, 'street'),
+    (PR_LOCALITY_W, 'city'),
+    (PR_POSTAL_CODE_W, 'postalcode'),
+    (PR_COUNTRY_W, 'country'),
+]
+
+# Address book details of all users, keyed on the username. Read once per run for --signature-template
+gal_details = None
+
+# Number of address book entries read from the table per call
+GAL_BATCH = 500
+
+
+"""
+Read the address book details of all users, or only of the given users, from
+the contents table of the global address book, in batches
+
+:param server: The server
+:param usernames: Only read these users, all users when empty
+:return: Dict of the SIGNATURE_FIELDS per username
+"""
+def read_gal_details(server, usernames=None):
+    details = {}
+    with server_call('gal'):
+        table = server.gab.GetContentsTable(0)
+        table.SetColumns([proptag for proptag, name in SIGNATURE_FIELDS], TBL_BATCH)
+        if usernames:
+            table.Restrict(SOrRestriction([SPropertyRestriction(RELOP_EQ, PR_ACCOUNT_W, SPropValue(PR_ACCOUNT_W, username))
+                                           for username in usernames]), TBL_BATCH)
+    while True:
+        with server_call('gal'):
+            rows = table.QueryRows(GAL_BATCH, 0)
+        if not rows:
+            break
+        for row in rows:
+            fields = {}
+            for (proptag, name), prop in zip(SIGNATURE_FIELDS, row):
+                fields[name] = prop.Value if PROP_TYPE(prop.ulPropTag) != PT_ERROR else ''
+            if fields['username']:
+                details[fields['username']] = fields
+    return details
+
+
+"""
+Address book details of a user, from the details read for all users or
+from the user itself
+
+:param user: The user
+:return: Dict of the SIGNATURE_FIELDS
+"""
+def user_details(user):
+    if gal_details is not None and user.name in gal_details:
+        return gal_details[user.name]
+    fields = {}
+    for proptag, name in SIGNATURE_FIELDS:
+        with server_call('gal'):
+            prop = user.get_prop(proptag)
+        fields[name] = prop.value if prop else ''
+    fields.update({'username': user.name, 'fullname': fields['fullname'] or user.fullname, 'email': fields['email'] or user.email})
+    return fields
+
+
+"""
+Read and check a signature template. The template is read once per run or
+daemon request, so a changed template is used by the next run. A ${field}
+must be one of the SIGNATURE_FIELDS, any other $ (e.g. a price or a script)
+is kept as it is.
+
+:param filename: The html template
+:return: The string.Template
+"""
+def load_signature_template(filename):
+    with open(filename, 'r') as f:
+        template = string.Template(f.read())
+    fields = set(name for proptag, name in SIGNATURE_FIELDS)
+    unknown = set()
+    for match in template.pattern.finditer(template.template):
+        if match.group('braced') and match.group('braced') not in fields:
+            print('Unknown field {} in signature template {}, use one of: {}'.format(
+                match.group(0), filename, ', '.join('$' + name for proptag, name in SIGNATURE_FIELDS)))
+            sys.exit(1)
+        if match.group('named') and match.group('named') not in fields:
+            unknown.add(match.group(0))
+    if unknown:
+        print('No such field, keeping {} in signature template {} as text'.format(', '.join(sorted(unknown)), filename))
+    return template
+
+
+"""
+Read the signature template of a run or daemon request into the options,
+before any user is processed
+
+:param options: Parser arguments
+"""
+def prepare_signature_template(options):
+    options.template = load_signature_template(options.signature_template)
+    if not options.signature_name:
+        options.signature_name = os.path.splitext(os.path.basename(options.signature_template))[0].replace('-', ' ')
+
+
+"""
+Add the signature of a template, filled in with the address book details of
+the user. The id is derived from the signature name, so deploying the same
+template again replaces the signature.
+
+:param user: The user
+:param template: The string.Template of load_signature_template
+:param name: The name of the signature
+:param default: Set the signature as default for new mail and replies
+"""
+def deploy_signature(user, template, name, default=None):
+    details = dict((key, html.escape(value)) for key, value in user_details(user).items())
+    # WebApp uses the time in milliseconds as id, a stable id of the same size
+    signatureid = str(int(hashlib.sha1(name.encode('utf-8')).hexdigest(), 16) % 10 ** 13)
+    store_signature(user, signatureid, name, template.safe_substitute(details), 'Deploying', default)
 
 
 """
@@ -400,16 +1404,21 @@ def export_categories(user, location=None):
     else:
         backup_location = '.'
     # first check if persistent settings exist
-    if not user.store.get_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W):
+    with server_call('read'):
+        persistent_settings = user.store.get_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W)
+    if not persistent_settings:
         print('Categories are not customized yet, so nothing to export')
-
-    persistent_settings =  json.loads(user.store.prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W).value)
+        return
 
     # Get categories
-    if not persistent_settings['settings']['kopano']['main'].get('categories'):
+    try:
+        categories = extract_path(persistent_settings.value, ['settings', 'kopano', 'main', 'categories'])
+    except ValueError:
+        categories = None
+    if not categories:
         print('Categories are not customized yet, so nothing to export')
+        return
 
-    categories = persistent_settings['settings']['kopano']['main']['categories']
     f = open('%s/%s-categories.json' % (backup_location, user.name), 'w')
     f.write(json.dumps(categories, sort_keys=True, indent=4, separators=(',', ': ')))
     f.close()
@@ -431,14 +1440,140 @@ def import_categories(user, filename=None):
     with open(restorename) as data_file:
         data = json.load(data_file)
 
-    if not user.store.get_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W):
+    with server_call('read'):
+        persistent_prop = user.store.get_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W)
+    if not persistent_prop:
         persistent_settings ={'settings': {'kopano': {'main': {'categories':data}}}}
     else:
-        persistent_settings = json.loads(user.store.get_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W).value)
+        persistent_settings = json_loads(persistent_prop.value)
         persistent_settings['settings']['kopano']['main']['categories'] = data
 
     print('Restoring categories for user {}'.format(user.name))
-    user.store.create_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W, json.dumps(persistent_settings))
+    with server_call('write'):
+        user.store.create_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W, json.dumps(persistent_settings))
+
+
+"""
+Read and check a category file. The file is read once per run or daemon
+request, so a changed file is used by the next run
+
+:param filename: The categories as exported by --export-categories
+:return: Tuple of the categories
+"""
+def load_categories(filename):
+    try:
+        with open(filename) as data_file:
+            categories = json.load(data_file)
+    except (IOError, ValueError) as e:
+        print('Could not read categories from {} (Error: {})'.format(filename, repr(e)))
+        sys.exit(1)
+    if not isinstance(categories, list) or not all(isinstance(category, dict) and category.get('name') for category in categories):
+        print('{} is not a list of categories with a name'.format(filename))
+        sys.exit(1)
+    return tuple(categories)
+
+
+"""
+Merge categories into the categories of the user by name. Categories the user
+does not have are added, the other categories of the user are kept. The
+settings are only written when something changed.
+
+:param user: The user
+:param categories: The categories of load_categories
+:param update_colors: Change the color of existing categories to the color in the file
+"""
+def merge_categories(user, categories, update_colors=None):
+    with server_call('read'):
+        persistent_prop = user.store.get_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W)
+    if persistent_prop:
+        persistent_settings = json_loads(persistent_prop.value)
+    else:
+        persistent_settings = {}
+    main = persistent_settings.setdefault('settings', {}).setdefault('kopano', {}).setdefault('main', {})
+    user_categories = main.get('categories') or []
+    existing = dict((category.get('name'), category) for category in user_categories)
+
+    added = updated = 0
+    for category in categories:
+        current = existing.get(category['name'])
+        if current is None:
+            user_categories.append(dict(category))
+            added += 1
+        elif update_colors and 'color' in category and current.get('color') != category['color']:
+            current['color'] = category['color']
+            updated += 1
+
+    if not added and not updated:
+        print('Categories of user {} already up to date'.format(user.name))
+        with write_counts_lock:
+            write_counts['unchanged'] += 1
+        return
+
+    main['categories'] = user_categories
+    print('Merging categories for user {}: {} added, {} colors changed'.format(user.name, added, updated))
+    with server_call('write'):
+        user.store.create_prop(PR_EC_WEBAPP_PERSISTENT_SETTINGS_JSON_W, json.dumps(persistent_settings))
+    with write_counts_lock:
+        write_counts['written'] += 1
+
+
+# Columns read from the S/MIME certificate items, the body is only opened for certificates that are exported
+SMIME_COLUMNS = [
+    (PR_ENTRYID, 'entryid'),
+    (PR_MESSAGE_CLASS_W, 'messageclass'),
+    (PR_SUBJECT_W, 'subject'),
+    (PR_SENDER_NAME_W, 'serial'),
+    (PR_CLIENT_SUBMIT_TIME, 'valid_from'),
+    (PR_MESSAGE_DELIVERY_TIME, 'valid_to'),
+    (PR_RECEIVED_BY_NAME_W, 'sha1'),
+    (PR_INTERNET_MESSAGE_ID_W, 'md5'),
+]
+
+# Number of certificates read from the table per call
+SMIME_BATCH = 100
+
+
+"""
+Read the S/MIME certificates of the user from the contents table of the
+associated folder. The table is restricted to the certificate items on the
+server and only the metadata columns are read, in batches.
+
+:param user: The user
+:param messageclasses: Message classes of the certificates to read
+:param expired_before: Only read certificates that expire before this datetime
+:param expired_after: Only read certificates that expire after this datetime
+:return: Generator of dicts with the columns of the certificates
+"""
+def smime_certificates(user, messageclasses=('WebApp.Security.Private', 'WebApp.Security.Public'), expired_before=None, expired_after=None):
+    restrictions = [SOrRestriction([SPropertyRestriction(RELOP_EQ, PR_MESSAGE_CLASS_W, SPropValue(PR_MESSAGE_CLASS_W, messageclass))
+                                    for messageclass in messageclasses])]
+    if expired_before:
+        restrictions.append(SPropertyRestriction(RELOP_LT, PR_MESSAGE_DELIVERY_TIME,
+            SPropValue(PR_MESSAGE_DELIVERY_TIME, MAPI.Time.unixtime(mktime(expired_before.timetuple())))))
+    if expired_after:
+        restrictions.append(SPropertyRestriction(RELOP_GE, PR_MESSAGE_DELIVERY_TIME,
+            SPropValue(PR_MESSAGE_DELIVERY_TIME, MAPI.Time.unixtime(mktime(expired_after.timetuple())))))
+    restriction = restrictions[0] if len(restrictions) == 1 else SAndRestriction(restrictions)
+
+    with server_call('associated'):
+        table = user.store.root.mapiobj.GetContentsTable(MAPI_ASSOCIATED)
+        table.SetColumns([proptag for proptag, name in SMIME_COLUMNS], TBL_BATCH)
+        table.Restrict(restriction, TBL_BATCH)
+    while True:
+        with server_call('associated'):
+            rows = table.QueryRows(SMIME_BATCH, 0)
+        if not rows:
+            break
+        for row in rows:
+            cert = {}
+            for (proptag, name), prop in zip(SMIME_COLUMNS, row):
+                if PROP_TYPE(prop.ulPropTag) == PT_ERROR:
+                    cert[name] = None
+                elif PROP_TYPE(proptag) == PT_SYSTIME:
+                    cert[name] = datetime.fromtimestamp(prop.Value.unixtime)
+                else:
+                    cert[name] = prop.Value
+            yield cert
 
 
 """
@@ -455,23 +1590,95 @@ def export_smime(user, location=None, public=None):
     else:
         backup_location = '.'
 
-    certificates =list(user.store.root.associated.items())
+    messageclasses = ['WebApp.Security.Private']
+    if public:
+        messageclasses.append('WebApp.Security.Public')
 
-    if len(certificates) == 0:
-        print('No certificates found')
-        return
-
-    for cert in certificates:
-        if public and cert.prop(PR_MESSAGE_CLASS_W).value == 'WebApp.Security.Public':
+    found = False
+    for cert in smime_certificates(user, messageclasses):
+        found = True
+        with server_call('associated'):
+            body = user.store.item(binascii.hexlify(cert['entryid']).decode('ascii')).text
+        if cert['messageclass'] == 'WebApp.Security.Public':
             extension = 'pub'
-            body = cert.text
+            body = body.encode('utf-8')
         else:
             extension = 'pfx'
-            body = base64.b64decode(cert.text)
+            body = base64.b64decode(body)
+
+        print('found {} certificate {} (serial: {})'.format(cert['messageclass'], cert['subject'], cert['serial']))
+        with open("%s/%s-%s.%s" % (backup_location, cert['subject'], cert['serial'], extension), "wb") as text_file:
+            text_file.write(body)
+
+    if not found:
+        print('No certificates found')
+
+
+"""
+Parse a private S/MIME certificate in PKCS12 format
+
+:param cert: The certificate in PKCS12 format
+:param passwd: The passphrase of the certificate
+:return: Dict with the properties of the certificate item
+"""
+def parse_pkcs12(cert, passwd):
+    p12 = OpenSSL.crypto.load_pkcs12(cert, passwd)
+
+    certificate = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, p12.get_certificate())
+    cert_data = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, certificate)
+    date_before = mktime(datetime.strptime(cert_data.get_notBefore().decode('utf-8'), "%Y%m%d%H%M%SZ" ).timetuple())
+    date_after = mktime(datetime.strptime(cert_data.get_notAfter().decode('utf-8'), "%Y%m%d%H%M%SZ" ).timetuple())
+
+    issued_by = ""
+    dict_issued_by = dict(cert_data.get_issuer().get_components())
+    for key in dict_issued_by:
+        issued_by += "%s=%s\n" % (key, dict_issued_by[key])
+
+    email = None
+    issued_to = ""
+    dict_issued_to = dict(cert_data.get_subject().get_components())
+    for key in dict_issued_to:
+        if key == b'emailAddress':
+            email = dict_issued_to[key].decode('utf-8')
+        else:
+            issued_to += "%s=%s\n" % (key, dict_issued_to[key])
+
+    return {
+        'email': email,
+        'date_before': date_before,
+        'date_after': date_after,
+        'serial': str(cert_data.get_serial_number()),
+        'issued_by': issued_by,
+        'issued_to': issued_to,
+        'sha1': cert_data.digest("sha1").decode('ascii'),
+        'md5': cert_data.digest("md5").decode('ascii'),
+        'body': base64.b64encode(p12.export()),
+    }
 
-            print('found {} certificate {} (serial: {})'.format(cert.prop(PR_MESSAGE_CLASS_W).value, cert.subject, cert.prop(PR_SENDER_NAME_W).value))
-            with open("%s/%s-%s.%s" % (backup_location, cert.subject, cert.prop(PR_SENDER_NAME_W).value, extension), "wb") as text_file:
-                text_file.write(body)
+
+"""
+Store a parsed private S/MIME certificate in the associated folder of the user
+
+:param user: The user
+:param cert: The certificate as returned by parse_pkcs12
+"""
+def store_smime(user, cert):
+    with server_call('associated'):
+        assoc = user.store.root.associated
+    item = assoc.mapiobj.CreateMessage(None, MAPI_ASSOCIATED)
+
+    item.SetProps([SPropValue(PR_SUBJECT, cert['email'].encode('utf-8')),
+                   SPropValue(PR_MESSAGE_CLASS, 'WebApp.Security.Private'.encode('utf-8')),
+                   SPropValue(PR_MESSAGE_DELIVERY_TIME, MAPI.Time.unixtime(cert['date_after'])),
+                   SPropValue(PR_CLIENT_SUBMIT_TIME, MAPI.Time.unixtime(cert['date_before'])),
+                   SPropValue(PR_SENDER_NAME, cert['serial'].encode('utf-8')),
+                   SPropValue(PR_SENDER_EMAIL_ADDRESS, cert['issued_by'].encode('utf-8')),
+                   SPropValue(PR_SUBJECT_PREFIX, cert['issued_to'].encode('utf-8')),
+                   SPropValue(PR_RECEIVED_BY_NAME, cert['sha1'].encode('ascii')),
+                   SPropValue(PR_INTERNET_MESSAGE_ID, cert['md5'].encode('ascii')),
+                   SPropValue(PR_BODY, cert['body'])])
+    with server_call('associated_write'):
+        item.SaveChanges(KEEP_OPEN_READWRITE)
 
 
 """
@@ -492,13 +1699,11 @@ def import_smime(user, cert_file, passwd, ask_password=None, public=None):
     elif not passwd:
         passwd = ''
 
-    assoc = user.store.root.associated
     with open(cert_file, 'rb') as f:
         cert = f.read()
     if not public:
-        messageclass = 'WebApp.Security.Private'
         try:
-            p12 = OpenSSL.crypto.load_pkcs12(cert, passwd)
+            cert = parse_pkcs12(cert, passwd)
         except IOError as e:
             print(e)
             sys.exit(1)
@@ -506,71 +1711,223 @@ def import_smime(user, cert_file, passwd, ask_password=None, public=None):
             print(e)
             sys.exit(1)
 
-        certificate = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, p12.get_certificate())
-        cert_data = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, certificate)
-        date_before = MAPI.Time.unixtime(mktime(datetime.strptime(cert_data.get_notBefore().decode('utf-8'), "%Y%m%d%H%M%SZ" ).timetuple()))
-        date_after = MAPI.Time.unixtime(mktime(datetime.strptime(cert_data.get_notAfter().decode('utf-8'), "%Y%m%d%H%M%SZ" ).timetuple()))
-
-        issued_by = ""
-        dict_issued_by = dict(cert_data.get_issuer().get_components())
-        for key in dict_issued_by:
-            issued_by += "%s=%s\n" % (key, dict_issued_by[key])
-
-        issued_to = ""
-        dict_issued_to = dict(cert_data.get_subject().get_components())
-        for key in dict_issued_to:
-            if key == b'emailAddress':
-                email = dict_issued_to[key].decode('utf-8')
-            else:
-                issued_to += "%s=%s\n" % (key, dict_issued_to[key])
-
-        if user.email == email:
-            item = assoc.mapiobj.CreateMessage(None, MAPI_ASSOCIATED)
-
-            item.SetProps([SPropValue(PR_SUBJECT, email.encode('utf-8')),
-                           SPropValue(PR_MESSAGE_CLASS, messageclass.encode('utf-8')),
-                           SPropValue(PR_MESSAGE_DELIVERY_TIME, date_after),
-                           SPropValue(PR_CLIENT_SUBMIT_TIME, date_before),
-                           SPropValue(PR_SENDER_NAME, str(cert_data.get_serial_number()).encode('utf-8')),
-                           SPropValue(PR_SENDER_EMAIL_ADDRESS, issued_by.encode('utf-8')),
-                           SPropValue(PR_SUBJECT_PREFIX, issued_to.encode('utf-8')),
-                           SPropValue(PR_RECEIVED_BY_NAME,  cert_data.digest("sha1")),
-                           SPropValue(PR_INTERNET_MESSAGE_ID,  cert_data.digest("md5")),
-                           SPropValue(PR_BODY,  base64.b64encode(p12.export()))])
-            item.SaveChanges(KEEP_OPEN_READWRITE)
+        if user.email == cert['email']:
+            store_smime(user, cert)
             print('Imported private certificate')
         else:
             print('Email address doesn\'t match')
 
+"""
+Parse a PKCS12 file, run in a worker process
+
+:param filename: The certificate file
+:param passwd: The passphrase of the certificate
+:return: Tuple of the filename, the parsed certificate and the error (None on success)
+"""
+def parse_pkcs12_file(filename, passwd):
+    try:
+        with open(filename, 'rb') as f:
+            return filename, parse_pkcs12(f.read(), passwd), None
+    except Exception as e:
+        return filename, None, str(e) or repr(e)
+
+
+"""
+Import the new certificates of a user, skipping the certificates the user
+already has. Certificates are compared on their SHA1 fingerprint, as
+certificates of different CAs can have the same serial.
+
+:param user: The user
+:param certificates: List of tuples of the filename and the parsed certificate
+:return: Tuple of the output lines and the number of imported certificates
+"""
+def import_user_smime(user, certificates):
+    existing = set()
+    for cert in smime_certificates(user, ['WebApp.Security.Private']):
+        existing.add(cert['sha1'])
+
+    lines = []
+    imported = 0
+    for filename, cert in certificates:
+        if cert['sha1'] in existing:
+            lines.append('{}: certificate {} (serial: {}) already imported'.format(user.name, filename, cert['serial']))
+            continue
+        store_smime(user, cert)
+        existing.add(cert['sha1'])
+        lines.append('{}: imported certificate {} (serial: {})'.format(user.name, filename, cert['serial']))
+        imported += 1
+    return lines, imported
+
+
+"""
+Import all private S/MIME certificates in a directory. The files are parsed
+and decrypted in parallel processes and every certificate is imported for the
+user with the email address of the certificate. The imports of the users run
+with --jobs workers.
+
+:param server: The server
+:param options: Parser arguments
+:return: Number of files that could not be imported
+"""
+def import_smime_directory(server, options):
+    if not sys.modules.get('OpenSSL'):
+        print('PyOpenSSl not installed \npip3 install pyOpenSSL')
+        sys.exit(1)
+    if options.ask_password:
+        passwd = getpass.getpass()
+    else:
+        passwd = options.password or ''
+
+    filenames = sorted(os.path.join(options.import_smime_dir, name) for name in os.listdir(options.import_smime_dir)
+                       if name.lower().endswith(('.p12', '.pfx')))
+    owners = {}
+    for user in selected_users(server, options):
+        if user.email:
+            owners[user.email.lower()] = user.name
+
+    failed = []
+    per_user = {}
+    # Decrypting PKCS12 is CPU bound, so the files are parsed in processes
+    with ProcessPoolExecutor(max_workers=options.jobs or None) as executor:
+        for filename, cert, error in executor.map(parse_pkcs12_file, filenames, repeat(passwd), chunksize=16):
+            if error:
+                print('{}: {}'.format(filename, error))
+                failed.append(filename)
+            elif not cert['email'] or cert['email'].lower() not in owners:
+                print('{}: no user with email address {}'.format(filename, cert['email']))
+                failed.append(filename)
+            else:
+                per_user.setdefault(owners[cert['email'].lower()], []).append((filename, cert))
+
+    def import_user(username):
+        try:
+            connection = worker_server(options) if options.jobs and options.jobs > 1 else server
+            return import_user_smime(connection.user(username), per_user[username]) + (None,)
+        except Exception as e:
+            return [], 0, repr(e)
+
+    imported = 0
+    with ThreadPoolExecutor(max_workers=options.jobs or 1) as executor:
+        for username, (lines, count, error) in zip(sorted(per_user), executor.map(import_user, sorted(per_user))):
+            for line in lines:
+                print(line)
+            if error:
+                print('{}: import failed: {}'.format(username, error))
+                failed.extend(filename for filename, cert in per_user[username])
+            imported += count
+
+    print('Imported {} certificates of {} files, {} failed'.format(imported, len(filenames), len(failed)))
+    return len(failed)
+
+
+# Columns of the S/MIME inventory
+INVENTORY_COLUMNS = ['user', 'type', 'subject', 'serial', 'valid_from', 'valid_to', 'sha1', 'md5']
+
+
+"""
+Read the S/MIME inventory of a user, only the metadata of the certificates
+is read
+
+:param user: The user
+:param options: Parser arguments
+:return: List of dicts with the INVENTORY_COLUMNS of the certificates
+"""
+def user_smime_inventory(user, options):
+    now = datetime.now()
+    expired_before = expired_after = None
+    if options.expires_within is not None:
+        expired_before = now + timedelta(days=options.expires_within)
+        if not options.expired:
+            expired_after = now
+    elif options.expired:
+        expired_before = now
+
+    rows = []
+    for cert in smime_certificates(user, expired_before=expired_before, expired_after=expired_after):
+        rows.append({
+            'user': user.name,
+            'type': 'public' if cert['messageclass'] == 'WebApp.Security.Public' else 'private',
+            'subject': cert['subject'],
+            'serial': cert['serial'],
+            'valid_from': cert['valid_from'].isoformat() if cert['valid_from'] else None,
+            'valid_to': cert['valid_to'].isoformat() if cert['valid_to'] else None,
+            'sha1': cert['sha1'],
+            'md5': cert['md5'],
+        })
+    return rows
+
+
+"""
+Write the S/MIME certificates of the selected users, one row per
+certificate, as CSV or JSON lines. The users are read with --jobs workers
+and the rows are written in the order of the users.
+
+:param server: The server
+:param options: Parser arguments
+:return: Number of users that failed
+"""
+def smime_inventory(server, options):
+    usernames = [user.name for user in selected_users(server, options)]
+
+    def inventory(username):
+        try:
+            connection = worker_server(options) if options.jobs and options.jobs > 1 else server
+            return user_smime_inventory(connection.user(username), options), None
+        except Exception as e:
+            return [], repr(e)
+
+    stream = sys.stdout if options.smime_inventory == '-' else open(options.smime_inventory, 'w', newline='')
+    writer = None
+    if options.smime_inventory.lower().endswith('.csv'):
+        writer = csv.DictWriter(stream, INVENTORY_COLUMNS)
+        writer.writeheader()
+
+    certificates = 0
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=options.jobs or 1) as executor:
+            for username, (rows, error) in zip(usernames, executor.map(inventory, usernames)):
+                if error:
+                    print('{}: inventory failed: {}'.format(username, error), file=sys.stderr)
+                    failed.append(username)
+                for row in rows:
+                    if writer:
+                        writer.writerow(row)
+                    else:
+                        stream.write(json.dumps(row) + '\n')
+                certificates += len(rows)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
+    print('Listed {} certificates of {} users, {} failed'.format(certificates, len(usernames), len(failed)), file=sys.stderr)
+    return len(failed)
+
+
 """
 Remove expired S/MIME Public certificates
 
 :param user: The user
 """
 def remove_expired_smime(user):
-    # unable to loop over the associated items so getting the items in a list instead
-    certificates =list(user.store.root.associated.items())
-
-    if len(certificates) == 0:
-        print('No certificates found')
+    # We only want to remove the public certificate
+    expired = list(smime_certificates(user, ['WebApp.Security.Public'], expired_before=datetime.now()))
+    if not expired:
+        print('No expired public certificates found')
         return
 
-    now = datetime.now()
-    for cert in certificates:
-        # We only want to remove the public certificate
-        if cert.prop(PR_MESSAGE_CLASS_W).value == 'WebApp.Security.Public':
-            if cert.prop(PR_MESSAGE_DELIVERY_TIME).value < now:
-                print('deleting public certificate {} ({})'.format(cert.subject, cert.prop(PR_MESSAGE_DELIVERY_TIME).value))
-                user.store.root.associated.delete(cert)
-    
+    for cert in expired:
+        print('deleting public certificate {} ({})'.format(cert['subject'], cert['valid_to']))
+    with server_call('associated_write'):
+        user.store.root.mapiobj.DeleteMessages([cert['entryid'] for cert in expired], 0, None, 0)
+
 """
 List sendas addresses
 
 :param user: The user
 """
 def list_sendas(user):
-    setting = read_settings(user)
-    sendas = (setting['settings']['zarafa']['v1']['contexts']['mail'].get('sendas', []))
+    sendas = read_settings_path(user, 'settings.zarafa.v1.contexts.mail.sendas', [])
     table_header = ["ID", "Name", 'Email', 'Reply mail', 'New mail', 'Forward mail']
     table_data =[]
     check = u"\u2714"
@@ -612,7 +1969,8 @@ def add_sendas(user, sendas_name, sendas_email, alias, sendas_forward=False, sen
             print('--sendas-name and --sendas-email are mandatory')
             sys.exit(1)
         print('Creating sendas line for {}'.format(sendas_email) )
-        entryid =  binascii.hexlify(user.server.ab.CreateOneOff(sendas_name, "SMTP", sendas_email, MAPI_SEND_NO_RICH_INFO| MAPI_UNICODE)).decode()
+        with server_call('one_off'):
+            entryid =  binascii.hexlify(user.server.ab.CreateOneOff(sendas_name, "SMTP", sendas_email, MAPI_SEND_NO_RICH_INFO| MAPI_UNICODE)).decode()
         sendas.append({
             "address_type": "SMTP",
             "display_name": sendas_name,
@@ -636,7 +1994,8 @@ def add_sendas(user, sendas_name, sendas_email, alias, sendas_forward=False, sen
             if address.startswith("SMTP"):
                continue
             email = address.replace("smtp:","")
-            entryid =  binascii.hexlify(user.server.ab.CreateOneOff(email, "SMTP", email, MAPI_SEND_NO_RICH_INFO| MAPI_UNICODE)).decode()
+            with server_call('one_off'):
+                entryid =  binascii.hexlify(user.server.ab.CreateOneOff(email, "SMTP", email, MAPI_SEND_NO_RICH_INFO| MAPI_UNICODE)).decode()
             sendas.append({
                 "address_type": "SMTP",
                 "display_name": email,
@@ -656,7 +2015,7 @@ def add_sendas(user, sendas_name, sendas_email, alias, sendas_forward=False, sen
             rowid += 1
     
     settings['settings']['zarafa']['v1']['contexts']['mail']['sendas'] = sendas
-    write_settings(user, json.dumps(settings))
+    write_settings(user, settings)
 
     list_sendas(user)
 """
@@ -683,7 +2042,7 @@ def del_sendas(user, del_sendas):
         print('removing row {}'.format(del_sendas))
 
     settings['settings']['zarafa']['v1']['contexts']['mail']['sendas'] = sendas
-    write_settings(user, json.dumps(settings))
+    write_settings(user, settings)
 
     list_sendas(user)
 
@@ -723,7 +2082,7 @@ def change_sendas(user, change_sendas, sendas_name, sendas_email, sendas_forward
     if changed:
         print('Writing new sendas settings')
         settings['settings']['zarafa']['v1']['contexts']['mail']['sendas'] = sendas
-        write_settings(user, json.dumps(settings))
+        write_settings(user, settings)
 
     list_sendas(user)        
 
@@ -749,7 +2108,7 @@ def advanced_inject(user, data, value_type='string'):
     keys =  split_data[0].strip().split('.')
     reduce(getitem, keys[:-1], settings)[keys[-1]] = value
 
-    write_settings(user, json.dumps(settings))
+    write_settings(user, settings)
 
 def get_pretty_table(iterable, header):
     max_len = [len(x) for x in header]
@@ -768,6 +2127,464 @@ def get_pretty_table(iterable, header):
     return output
 
 
+"""
+Run all requested operations for a single user
+
+:param user: The user
+:param options: Parser arguments
+"""
+def process_user(user, options):
+    # Backup and restore
+    if options.backup:
+        if archive:
+            backup_archive(user)
+        elif incremental:
+            backup_incremental(user)
+        else:
+            backup(user, options.location)
+    if options.restore:
+        if archive:
+            restore_archive(user)
+        elif incremental:
+            restore_incremental(user, options.restore_point)
+        else:
+            restore(user, options.file)
+
+    # Language
+    if options.language:
+        language(user, options.language)
+
+    if options.add_store:
+        add_store(user, options.add_store, options.folder_type, options.sub_folder)
+
+    if options.del_store:
+        del_store(user, options.del_store, options.folder_type)
+
+    if options.list_stores:
+        list_stores(user)
+
+    #Categories
+    if options.export_categories:
+        export_categories(user, options.file)
+    if options.import_categories:
+        import_categories(user, options.file)
+    if options.merge_categories:
+        merge_categories(user, options.categories, options.update_colors)
+
+    # S/MIME import/export
+    if options.export_smime:
+        export_smime(user, options.location, options.public_smime)
+    if options.import_smime:
+        import_smime(user, options.import_smime, options.password, options.ask_password, options.public_smime)
+    if options.remove_expired:
+        remove_expired_smime(user)
+
+    # Signature
+    if options.backup_signature:
+        if signature_store:
+            backup_signature_store(user)
+        else:
+            backup_signature(user, options.location)
+    if options.restore_signature:
+        restore_signature(user,  options.restore_signature, False, options.default_signature)
+    if options.replace_signature:
+        restore_signature(user,  options.replace_signature, True, options.default_signature)
+    if options.signature_template:
+        deploy_signature(user, options.template, options.signature_name, options.default_signature)
+
+    # Advanced injection option
+    if options.add_option:
+        advanced_inject(user, options.add_option)
+
+    # Theme
+    if options.theme:
+        setting = 'settings.zarafa.v1.main.active_theme = {}'.format(options.theme)
+        advanced_inject(user, setting)
+        print('Theme changed to {}'.format(options.theme))
+
+    # Free busy publishing
+    if options.freebusy:
+        if int(options.freebusy) > 36:
+            options.freebusy = 36
+            print('Maximum publishing months is 36. Using 36 instead.')
+        setting = 'settings.zarafa.v1.contexts.calendar.free_busy_range = {}'.format(options.freebusy)
+        advanced_inject(user, setting)
+        if int(options.freebusy) == 0:
+            print('Free/Busy publishing disabled')
+        else:
+            print('Free/Busy published for {} months '.format(options.freebusy))
+
+    # Icon set
+    if options.icons:
+        accepted_icons = {'Breeze', 'Classic'}
+        if not options.icons in accepted_icons:
+            print('Valid syntax: Breeze or Classic')
+            sys.exit(1)
+        setting = 'settings.zarafa.v1.main.active_iconset = {}'.format(options.icons)
+        advanced_inject(user, setting)
+        print('Icon set changed to {}'.format(options.icons))
+
+    # Editor
+    if options.htmleditor:
+        accepted_editors = {'htmleditor-minimaltiny', 'full_tinymce'}
+        if not options.htmleditor in accepted_editors:
+            print('Valid syntax: htmleditor-minimaltiny or full_tinymce')
+            sys.exit(1)
+        setting = 'settings.zarafa.v1.contexts.mail.html_editor = {}'.format(options.htmleditor)
+        advanced_inject(user, setting)
+        print('Editor changed to {}'.format(options.htmleditor))
+
+    # State settings
+    if options.remove_state:
+        settings = read_settings(user)
+        settings['settings']['zarafa']['v1']['state'] = {}
+        write_settings(user, settings)
+        print('Removed state settings for {}'.format(user.name))
+
+    # Add sender to safe sender list
+    if options.add_sender:
+        setting = 'settings.zarafa.v1.contexts.mail.safe_senders_list = {}'.format(options.add_sender)
+        advanced_inject(user, setting, 'list')
+        print('{}'.format(options.add_sender), 'Added to safe sender list for {}'.format(user.name))
+
+    # Polling interval
+    if options.polling_interval:
+        try:
+            value = int(options.polling_interval)
+        except ValueError:
+            print('Invalid number used. Please specify the value in seconds')
+            sys.exit(1)
+        setting = 'settings.zarafa.v1.main.reminder.polling_interval = {}'.format(options.polling_interval)
+        advanced_inject(user, setting)
+        print('Polling interval changed to', '{}'.format(options.polling_interval), 'for {}'.format(user.name))
+
+    # Calendar resolution (zoom level)
+    if options.calendar_resolution:
+        try:
+            value = int(options.calendar_resolution)
+        except ValueError:
+            print('Invalid number used. Please specify the value in minutes')
+            sys.exit(1)
+        if value < 5 or value > 60:
+            print('Unsupported value used. Use a number between 5 and 60')
+            sys.exit(1)
+        setting = 'settings.zarafa.v1.contexts.calendar.default_zoom_level = {}'.format(options.calendar_resolution)
+        advanced_inject(user, setting)
+        print('Calendar resolution changed to', '{}'.format(options.calendar_resolution), 'for {}'.format(user.name))
+
+    # Sendas
+    if options.list_sendas:
+        list_sendas(user)
+
+    if options.add_sendas:
+        add_sendas(user, options.sendas_name, options.sendas_email, options.sendas_alias,
+        options.sendas_forward, options.sendas_new, options.sendas_reply)
+
+    if options.del_sendas:
+        del_sendas(user, options.del_sendas)
+    
+    if options.change_sendas:
+        change_sendas(user, options.change_sendas,options.sendas_name, options.sendas_email, 
+        options.sendas_forward, options.sendas_new, options.sendas_reply)
+
+    # Always at last!!!
+    if options.reset:
+        reset_settings(user)
+
+
+"""
+Run all requested operations for a single user within a settings session
+
+:param user: The user
+:param options: Parser arguments
+:return: False if the settings could not be written
+"""
+def handle_user(user, options):
+    if metrics:
+        metrics.local.user = user.name
+    open_settings(user)
+    status = 'failed'
+    stored = False
+    try:
+        process_user(user, options)
+        status = 'ok'
+    finally:
+        settings, stored = commit_settings(user)
+        if not stored:
+            # Not journaled as done, so --resume processes the user again
+            status = 'failed'
+            settings = None
+        if journal:
+            journal.record(user.name, status, settings)
+        if metrics:
+            metrics.local.user = None
+    return stored
+
+
+"""
+Users to process, without the users that already completed the operation
+when resuming
+
+:param server: The server
+:param options: Parser arguments
+"""
+def selected_users(server, options):
+    completed = set()
+    if journal and options.resume:
+        completed = journal.completed()
+
+    skipped = 0
+    users = server.users(options.users)
+    while True:
+        with timed('users'):
+            user = next(users, None)
+        if user is None:
+            break
+        if user.name in completed:
+            skipped += 1
+            continue
+        yield user
+
+    if skipped:
+        print('Skipped {} users that already completed according to the journal'.format(skipped))
+
+
+"""
+Stdout replacement that collects the output of each worker thread in its own
+buffer, so the output of a user can be printed as one block.
+"""
+class WorkerOutput(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(data)
+        return buffer.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+# Per worker thread state (server connection)
+worker = threading.local()
+
+
+"""
+Server connection of the current worker thread, every worker has its own
+
+:param options: Parser arguments
+:return: The server
+"""
+def worker_server(options):
+    if not hasattr(worker, 'server'):
+        with server_call('logon'):
+            worker.server = kopano.Server(options)
+    return worker.server
+
+
+"""
+Process a single user in a worker thread
+
+:param options: Parser arguments
+:param username: The name of the user
+:return: Tuple of the output and the error (None on success)
+"""
+def run_worker(options, username):
+    output = sys.stdout
+    output.local.buffer = io.StringIO()
+    error = None
+    try:
+        if not handle_user(worker_server(options).user(username), options):
+            error = 'could not write the WebApp settings'
+    except SystemExit as e:
+        error = 'exited with code {}'.format(e.code)
+    except Exception as e:
+        error = repr(e)
+    finally:
+        text = output.local.buffer.getvalue()
+        output.local.buffer = None
+    return text, error
+
+
+"""
+Process the users with a pool of worker threads. The output of every user is
+printed in the order of the user list, followed by a summary.
+
+:param server: The server
+:param options: Parser arguments
+"""
+def run_parallel(server, options):
+    usernames = [user.name for user in selected_users(server, options)]
+    failed = []
+
+    stdout = sys.stdout
+    sys.stdout = WorkerOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            for username, (text, error) in zip(usernames, executor.map(lambda name: run_worker(options, name), usernames)):
+                stdout.write('[{}]\n{}'.format(username, text))
+                if error:
+                    stdout.write('[{}] failed: {}\n'.format(username, error))
+                    failed.append((username, error))
+                stdout.flush()
+    finally:
+        sys.stdout = stdout
+
+    print('Processed {} users: {} succeeded, {} failed'.format(len(usernames), len(usernames) - len(failed), len(failed)))
+    for username, error in failed:
+        print('  {}: {}'.format(username, error))
+    return len(failed)
+
+
+"""
+Pool of server connections used by the daemon. Connections are created when
+needed, up to the size of the pool, and kept open between requests.
+"""
+class ServerPool(object):
+    def __init__(self, options, size):
+        self.options = options
+        self.slots = threading.Semaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        self.slots.acquire()
+        try:
+            with self.lock:
+                if self.idle:
+                    return self.idle.pop()
+            with server_call('logon'):
+                return kopano.Server(self.options)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    # A connection that failed is not reused
+    def put(self, server, healthy=True):
+        if healthy:
+            with self.lock:
+                self.idle.append(server)
+        self.slots.release()
+
+
+# Server connections of the daemon
+server_pool = None
+
+# Errors after which a server connection of the daemon is not reused
+CONNECTION_ERRORS = (MAPIErrorNetworkError, MAPIErrorEndOfSession)
+
+# Options that can not be used in a daemon request
+DAEMON_UNSUPPORTED = ('daemon', 'jobs', 'latency_target', 'max_ops', 'journal', 'resume', 'stats', 'prometheus',
+                      'archive', 'incremental', 'restore_point', 'ask_password', 'import_smime_dir', 'smime_inventory')
+
+
+"""
+Run a daemon request
+
+:param args: Command line arguments of the request
+:return: Exit code
+"""
+def run_request(args):
+    options, args = opt_args(args=args)
+    unsupported = [name for name in DAEMON_UNSUPPORTED if getattr(options, name, None)]
+    if unsupported:
+        print('Not supported in daemon requests: {}'.format(', '.join(unsupported)))
+        return 1
+    if not options.users and not options.all_users:
+        print('There are no users specified. Use "--all-users" to run for all users')
+        return 1
+    if options.signature_template:
+        prepare_signature_template(options)
+    if options.merge_categories:
+        options.categories = load_categories(options.merge_categories)
+
+    server = server_pool.get()
+    healthy = True
+    failed = 0
+    try:
+        for user in server.users(options.users):
+            if not handle_user(user, options):
+                failed += 1
+    except CONNECTION_ERRORS:
+        # Other errors, e.g. an unknown user, leave the connection usable
+        healthy = False
+        raise
+    finally:
+        server_pool.put(server, healthy)
+    return 1 if failed else 0
+
+
+"""
+Handles a connection to the daemon. A request is a JSON line with the command
+line arguments, e.g. {"args": ["-u", "john", "--theme", "dark"]}. The reply is
+a JSON line with the exit code and the output, e.g. {"status": 0, "output": "..."}.
+"""
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        buffer = io.StringIO()
+        sys.stdout.local.buffer = buffer
+        sys.stderr.local.buffer = buffer
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            status = run_request([str(arg) for arg in request.get('args', [])])
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print(e.code)
+                status = 1
+        except Exception as e:
+            print('Error: {!r}'.format(e))
+            status = 1
+        finally:
+            sys.stdout.local.buffer = None
+            sys.stderr.local.buffer = None
+        self.wfile.write((json.dumps({'status': status, 'output': buffer.getvalue()}) + '\n').encode('utf-8'))
+
+
+"""
+Run as daemon, handling requests on a Unix socket until interrupted
+
+:param options: Parser arguments
+:param size: Maximum number of server connections
+"""
+def run_daemon(options, size):
+    global server_pool
+    server_pool = ServerPool(options, size)
+    # Log on once at startup, so configuration problems show up right away
+    server_pool.put(server_pool.get())
+
+    # Only a socket left behind by an earlier daemon is removed
+    if os.path.lexists(options.daemon):
+        if not stat.S_ISSOCK(os.lstat(options.daemon).st_mode):
+            print('{} exists and is not a socket'.format(options.daemon))
+            sys.exit(1)
+        os.unlink(options.daemon)
+    # The daemon has the privileges of the admin user, only allow the owner to
+    # connect. The socket is created without permissions for others.
+    umask = os.umask(0o077)
+    try:
+        daemon = socketserver.ThreadingUnixStreamServer(options.daemon, DaemonHandler)
+    finally:
+        os.umask(umask)
+    daemon.daemon_threads = True
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = WorkerOutput(stdout), WorkerOutput(stderr)
+    print('Waiting for requests on {}'.format(options.daemon))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        daemon.server_close()
+        os.unlink(options.daemon)
+
+
 """
 Main function run with arguments
 """
@@ -778,155 +2595,86 @@ def main():
 
     # If the script should execute for all users
     # The admin should pass the '--all-users' parameter
-    if not options.users and not options.all_users:
+    if not options.users and not options.all_users and not options.daemon:
         print('There are no users specified. Use "--all-users" to run for all users')
         sys.exit(1)
 
-    server = kopano.Server(options)
+    if options.daemon and (options.journal or options.archive or options.incremental or options.restore_point or options.stats or options.prometheus):
+        print('--daemon can not be combined with --journal, --archive, --incremental, --restore-point, --stats or --prometheus')
+        sys.exit(1)
 
-    for user in server.users(options.users):
-        # Backup and restore
-        if options.backup:
-            backup(user, options.location)
-        if options.restore:
-            restore(user, options.file)
+    if options.resume and not options.journal:
+        print('--resume needs the journal of the earlier run, use "--journal <file>"')
+        sys.exit(1)
 
-        # Language
-        if options.language:
-            language(user, options.language)
+    # A run starts without the state of an earlier run in the same process
+    global throttle, journal, archive, incremental, signature_store, metrics, gal_details
+    throttle = journal = archive = incremental = signature_store = metrics = gal_details = None
+    write_counts.update(written=0, unchanged=0, failed=0)
+    if options.journal:
+        journal = Journal(options.journal, operation_name(options))
 
-        if options.add_store:
-            add_store(user, options.add_store, options.folder_type, options.sub_folder)
+    if options.stats or options.prometheus:
+        metrics = Metrics(operation_name(options))
 
-        if options.del_store:
-            del_store(user, options.del_store, options.folder_type)
+    # The daemon handles requests in parallel, by default with up to 4 server connections
+    workers = options.jobs or (4 if options.daemon else 1)
+    if options.latency_target or options.max_ops:
+        throttle = Throttle(workers, options.latency_target, options.max_ops)
 
-        if options.list_stores:
-            list_stores(user)
+    if options.daemon:
+        run_daemon(options, workers)
+        return
 
-        #Categories
-        if options.export_categories:
-            export_categories(user, options.file)
-        if options.import_categories:
-            import_categories(user, options.file)
+    if options.signature_template:
+        # Check the template before any user is processed
+        prepare_signature_template(options)
+    if options.merge_categories:
+        options.categories = load_categories(options.merge_categories)
 
-        # S/MIME import/export
-        if options.export_smime:
-            export_smime(user, options.location, options.public_smime)
-        if options.import_smime:
-            import_smime(user, options.import_smime, options.password, options.ask_password, options.public_smime)
-        if options.remove_expired:
-            remove_expired_smime(user)
+    if options.archive:
+        archive = Archive(options.archive)
+    elif (options.backup or options.restore) and (options.incremental or options.restore_point):
+        incremental = IncrementalBackup(options.location)
+    if options.backup_signature and options.incremental:
+        signature_store = SignatureStore(options.location)
 
-        # Signature
-        if options.backup_signature:
-            backup_signature(user, options.location)
-        if options.restore_signature:
-            restore_signature(user,  options.restore_signature, False, options.default_signature)
-        if options.replace_signature:
-            restore_signature(user,  options.replace_signature, True, options.default_signature)
-
-        # Advanced injection option
-        if options.add_option:
-            advanced_inject(user, options.add_option)
-
-        # Theme
-        if options.theme:
-            setting = 'settings.zarafa.v1.main.active_theme = {}'.format(options.theme)
-            advanced_inject(user, setting)
-            print('Theme changed to {}'.format(options.theme))
-
-        # Free busy publishing
-        if options.freebusy:
-            if int(options.freebusy) > 36:
-                options.freebusy = 36
-                print('Maximum publishing months is 36. Using 36 instead.')
-            setting = 'settings.zarafa.v1.contexts.calendar.free_busy_range = {}'.format(options.freebusy)
-            advanced_inject(user, setting)
-            if int(options.freebusy) == 0:
-                print('Free/Busy publishing disabled')
-            else:
-                print('Free/Busy published for {} months '.format(options.freebusy))
-
-        # Icon set
-        if options.icons:
-            accepted_icons = {'Breeze', 'Classic'}
-            if not options.icons in accepted_icons:
-                print('Valid syntax: Breeze or Classic')
-                sys.exit(1)
-            setting = 'settings.zarafa.v1.main.active_iconset = {}'.format(options.icons)
-            advanced_inject(user, setting)
-            print('Icon set changed to {}'.format(options.icons))
-
-        # Editor
-        if options.htmleditor:
-            accepted_editors = {'htmleditor-minimaltiny', 'full_tinymce'}
-            if not options.htmleditor in accepted_editors:
-                print('Valid syntax: htmleditor-minimaltiny or full_tinymce')
-                sys.exit(1)
-            setting = 'settings.zarafa.v1.contexts.mail.html_editor = {}'.format(options.htmleditor)
-            advanced_inject(user, setting)
-            print('Editor changed to {}'.format(options.htmleditor))
-
-        # State settings
-        if options.remove_state:
-            settings = read_settings(user)
-            settings['settings']['zarafa']['v1']['state'] = {}
-            write_settings(user, json.dumps(settings))
-            print('Removed state settings for {}'.format(user.name))
-
-        # Add sender to safe sender list
-        if options.add_sender:
-            settings = read_settings(user)
-            setting = 'settings.zarafa.v1.contexts.mail.safe_senders_list = {}'.format(options.add_sender)
-            advanced_inject(user, setting, 'list')
-            print('{}'.format(options.add_sender), 'Added to safe sender list for {}'.format(user.name))
-
-        # Polling interval
-        if options.polling_interval:
-            try:
-                value = int(options.polling_interval)
-            except ValueError:
-                print('Invalid number used. Please specify the value in seconds')
-                sys.exit(1)
-            settings = read_settings(user)
-            setting = 'settings.zarafa.v1.main.reminder.polling_interval = {}'.format(options.polling_interval)
-            advanced_inject(user, setting)
-            print('Polling interval changed to', '{}'.format(options.polling_interval), 'for {}'.format(user.name))
-
-        # Calendar resolution (zoom level)
-        if options.calendar_resolution:
-            try:
-                value = int(options.calendar_resolution)
-            except ValueError:
-                print('Invalid number used. Please specify the value in minutes')
-                sys.exit(1)
-            if value < 5 or value > 60:
-                print('Unsupported value used. Use a number between 5 and 60')
-                sys.exit(1)
-            settings = read_settings(user)
-            setting = 'settings.zarafa.v1.contexts.calendar.default_zoom_level = {}'.format(options.calendar_resolution)
-            advanced_inject(user, setting)
-            print('Calendar resolution changed to', '{}'.format(options.calendar_resolution), 'for {}'.format(user.name))
-
-        # Sendas
-        if options.list_sendas:
-            list_sendas(user)
-
-        if options.add_sendas:
-            add_sendas(user, options.sendas_name, options.sendas_email, options.sendas_alias,
-            options.sendas_forward, options.sendas_new, options.sendas_reply)
-
-        if options.del_sendas:
-            del_sendas(user, options.del_sendas)
-        
-        if options.change_sendas:
-            change_sendas(user, options.change_sendas,options.sendas_name, options.sendas_email, 
-            options.sendas_forward, options.sendas_new, options.sendas_reply)
-
-        # Always at last!!!
-        if options.reset:
-            reset_settings(user)
+    with server_call('logon'):
+        server = kopano.Server(options)
+
+    # Reading the address book in one go only pays off for more than one user
+    if options.signature_template and (options.all_users or len(options.users) > 1):
+        gal_details = read_gal_details(server, None if options.all_users else options.users)
+
+    failed = 0
+    try:
+        if options.import_smime_dir:
+            failed = import_smime_directory(server, options)
+        elif options.smime_inventory:
+            failed = smime_inventory(server, options)
+        elif options.jobs and options.jobs > 1:
+            failed = run_parallel(server, options)
+        else:
+            for user in selected_users(server, options):
+                if not handle_user(user, options):
+                    failed += 1
+    finally:
+        if archive:
+            archive.close()
+        if incremental:
+            incremental.save()
+        if signature_store:
+            signature_store.save()
+        if metrics and options.stats:
+            metrics.write_json(options.stats)
+        if metrics and options.prometheus:
+            metrics.write_prometheus(options.prometheus)
+
+    if write_counts['written'] or write_counts['unchanged'] or write_counts['failed']:
+        print('WebApp settings written for {} users, {} users unchanged, {} users failed'.format(
+            write_counts['written'], write_counts['unchanged'], write_counts['failed']))
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":